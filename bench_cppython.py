@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Startup time benchmark of cppython
+
+Every case runs in a fresh python process, the best of several runs is
+reported. The last two cases show what each run paid before clang.cindex and
+libclang were loaded on demand.
+
+With --events header.hpp, visitor events per second of generating the
+header are measured instead: its events are parsed once and replayed into
+the generation visitors, both by VisitorGroup and by the dispatch it had
+before, which looked up every handler of every event again.
+'''
+from __future__ import print_function
+
+import sys
+import os
+import time
+import argparse
+import subprocess
+
+__author__ = 'ZHUO Qiang'
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+CASES = (
+    ('python', ['-c', 'pass']),
+    ('import cppython', ['-c', 'import cppython']),
+    ('cppython.py --version', ['cppython.py', '--version']),
+    ('import cppython + clang.cindex', ['-c', 'import cppython; cppython.cindex.Config']),
+    ('import cppython + load libclang', ['-c', 'import cppython; cppython.cindex.conf.lib']),
+)
+
+
+def measure(args, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, cwd=DIRECTORY,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class GetattrGroup(object):
+    '''VisitorGroup dispatch before handlers were resolved once, for comparison
+    '''
+    def __init__(self, visitors):
+        self.visitors = list(visitors)
+
+    def __getattr__(self, name):
+        def method(*l, **kw):
+            for visitor in self.visitors:
+                getattr(visitor, name)(*l, **kw)
+        return method
+
+
+def measure_events(header, repeat):
+    import cppython
+
+    events = cppython.parse_events(header)
+    cases = (
+        ('getattr per event', GetattrGroup),
+        ('VisitorGroup.replay', cppython.VisitorGroup),
+    )
+    print('{} events of {}'.format(len(events), header))
+    for name, group_type in cases:
+        best = None
+        for i in range(repeat):
+            # generated files are kept in memory
+            group = group_type(v('bench', DIRECTORY, None, {}) for v in cppython.VISITORS)
+            start = time.time()
+            cppython.replay(events, group)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print('{:<36}{:>12.0f} events/s'.format(name, len(events) / best))
+
+
+def main(argv):
+    cmd_parser = argparse.ArgumentParser()
+    cmd_parser.add_argument('-n', '--repeat', metavar='N', type=int, default=10,
+                            help='run each case N times, default to 10')
+    cmd_parser.add_argument('--events', metavar='header.hpp',
+                            help='measure visitor events per second of generating header instead of startup time')
+    args = cmd_parser.parse_args(argv[1:])
+
+    if args.events:
+        measure_events(args.events, args.repeat)
+        return
+
+    for name, case in CASES:
+        print('{:<36}{:>8.1f} ms'.format(name, measure(case, args.repeat) * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
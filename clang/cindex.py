@@ -472,6 +472,52 @@ class TokenGroup(object):
 
             yield token
 
+    @staticmethod
+    def get_token_data(tu, extent, limit=None):
+        """Return kinds, spellings and extents of the tokens in an extent.
+
+        The three lists are parallel and filled in one pass over the token
+        buffer, which is disposed of before returning. Kinds are read from the
+        buffer itself and each token is copied into the same Token for the
+        spelling and extent calls, so no Token is created per token.
+
+        libclang always tokenizes the whole extent; if limit is given only the
+        first limit tokens are read from the buffer and returned.
+        """
+        tokens_memory = POINTER(Token)()
+        tokens_count = c_uint()
+
+        conf.lib.clang_tokenize(tu, extent, byref(tokens_memory),
+                byref(tokens_count))
+
+        kinds, spellings, extents = [], [], []
+        count = int(tokens_count.value)
+        if count < 1:
+            return kinds, spellings, extents
+
+        try:
+            if limit is not None:
+                count = min(count, limit)
+            size = sizeof(Token)
+            address = cast(tokens_memory, c_void_p).value
+            # the kind of a token is its first int_data
+            raw = cast(tokens_memory, POINTER(c_uint))
+            stride = size // sizeof(c_uint)
+            token = Token()
+            token_address = addressof(token)
+            get_spelling = conf.lib.clang_getTokenSpelling
+            get_extent = conf.lib.clang_getTokenExtent
+            from_value = TokenKind.from_value
+            for i in range(count):
+                kinds.append(from_value(raw[i * stride]))
+                memmove(token_address, address + i * size, size)
+                spellings.append(get_spelling(tu, token))
+                extents.append(get_extent(tu, token))
+        finally:
+            conf.lib.clang_disposeTokens(tu, tokens_memory, tokens_count)
+
+        return kinds, spellings, extents
+
 class TokenKind(object):
     """Describes a specific type of a Token."""
 
@@ -1423,6 +1469,43 @@ class Cursor(Structure):
             for descendant in child.walk_preorder():
                 yield descendant
 
+    def visit_subtree(self, enter, leave):
+        """Walk the descendants of this cursor with a single clang_visitChildren call.
+
+        enter(child, parent) is called for each visited cursor and returns None
+        or False to skip its children, True to visit them. Once all the
+        children of a cursor are visited, leave(cursor) is called. Only the
+        cursors from this one down to the current one are referenced during
+        the walk. Exception raised by enter or leave stops the walk and is
+        raised again once clang_visitChildren returns.
+        """
+        # cursors whose children are being visited
+        stack = [self]
+        # exception raised by enter or leave, ctypes would only print it
+        errors = []
+        def visitor(child, parent, data):
+            if errors:
+                # break does not stop every level of the traversal
+                return 0 # break
+            try:
+                while stack[-1] != parent:
+                    leave(stack.pop())
+                child._tu = self._tu
+                recurse = enter(child, parent)
+            except BaseException as e:
+                errors.append(e)
+                return 0 # break
+            if recurse:
+                stack.append(child)
+                return 2 # recurse
+            return 1 # continue
+        conf.lib.clang_visitChildren(self, callbacks['cursor_visit'](visitor),
+            None)
+        if errors:
+            raise errors[0]
+        while len(stack) > 1:
+            leave(stack.pop())
+
     def get_tokens(self):
         """Obtain Token instances formulating that compose this Cursor.
 
@@ -1431,6 +1514,41 @@ class Cursor(Structure):
         """
         return TokenGroup.get_tokens(self._tu, self.extent)
 
+    def get_token_data(self, limit=None):
+        """Return kinds, spellings and extents of the tokens of this cursor.
+
+        See TokenGroup.get_token_data.
+        """
+        return TokenGroup.get_token_data(self._tu, self.extent, limit)
+
+    def evaluate(self):
+        """Evaluate the entity pointed at by the cursor as a constant expression.
+
+        Returns an int or float, or None if it could not be evaluated. This
+        requires libclang 3.9 or later, older ones always return None.
+        """
+        if not conf.function_exists('clang_Cursor_Evaluate'):
+            return None
+
+        result = conf.lib.clang_Cursor_Evaluate(self)
+        if not result:
+            return None
+
+        try:
+            kind = conf.lib.clang_EvalResult_getKind(result)
+            if kind == EVAL_RESULT_INT:
+                if (conf.function_exists('clang_EvalResult_isUnsignedInt')
+                    and conf.lib.clang_EvalResult_isUnsignedInt(result)):
+                    return conf.lib.clang_EvalResult_getAsUnsigned(result)
+                if conf.function_exists('clang_EvalResult_getAsLongLong'):
+                    return conf.lib.clang_EvalResult_getAsLongLong(result)
+                return conf.lib.clang_EvalResult_getAsInt(result)
+            if kind == EVAL_RESULT_FLOAT:
+                return conf.lib.clang_EvalResult_getAsDouble(result)
+            return None
+        finally:
+            conf.lib.clang_EvalResult_dispose(result)
+
     def is_bitfield(self):
         """
         Check if the field is a bitfield.
@@ -1476,6 +1594,10 @@ class Cursor(Structure):
         res._tu = args[0]._tu
         return res
 
+# Maps to CXEvalResultKind.
+EVAL_RESULT_INT = 1
+EVAL_RESULT_FLOAT = 2
+
 ### C++ access specifiers ###
 
 class AccessSpecifier(object):
@@ -2267,8 +2389,10 @@ class TranslationUnit(ClangObject):
             for i, (name, contents) in enumerate(unsaved_files):
                 if hasattr(contents, "read"):
                     contents = contents.read()
+                # length is in bytes, not in characters
+                contents = b(contents)
 
-                unsaved_array[i].name = name
+                unsaved_array[i].name = b(name)
                 unsaved_array[i].contents = contents
                 unsaved_array[i].length = len(contents)
 
@@ -2312,10 +2436,22 @@ class TranslationUnit(ClangObject):
         """
         assert isinstance(index, Index)
 
+        # Keep the index alive as long as the translation unit using it.
+        self.index = index
         ClangObject.__init__(self, ptr)
 
     def __del__(self):
-        conf.lib.clang_disposeTranslationUnit(self)
+        self.dispose()
+
+    def dispose(self):
+        """Free the translation unit now instead of when it is garbage collected.
+
+        Neither the translation unit nor anything obtained from it, e.g. its
+        cursors, may be used afterwards.
+        """
+        if self.obj:
+            conf.lib.clang_disposeTranslationUnit(self)
+            self.obj = self._as_parameter_ = c_object_p()
 
     @property
     def cursor(self):
@@ -2444,14 +2580,14 @@ class TranslationUnit(ClangObject):
         if len(unsaved_files):
             unsaved_files_array = (_CXUnsavedFile * len(unsaved_files))()
             for i,(name,value) in enumerate(unsaved_files):
-                if not isinstance(value, str):
+                if hasattr(value, "read"):
                     # FIXME: It would be great to support an efficient version
                     # of this, one day.
                     value = value.read()
-                    print(value)
-                if not isinstance(value, str):
+                value = b(value)
+                if not isinstance(value, bytes):
                     raise TypeError('Unexpected unsaved file contents.')
-                unsaved_files_array[i].name = name
+                unsaved_files_array[i].name = b(name)
                 unsaved_files_array[i].contents = value
                 unsaved_files_array[i].length = len(value)
         ptr = conf.lib.clang_reparseTranslationUnit(self, len(unsaved_files),
@@ -2473,7 +2609,7 @@ class TranslationUnit(ClangObject):
         filename -- The path to save the translation unit to.
         """
         options = conf.lib.clang_defaultSaveOptions(self)
-        result = int(conf.lib.clang_saveTranslationUnit(self, filename,
+        result = int(conf.lib.clang_saveTranslationUnit(self, b(filename),
                                                         options))
         if result != 0:
             raise TranslationUnitSaveError(result,
@@ -2508,14 +2644,14 @@ class TranslationUnit(ClangObject):
         if len(unsaved_files):
             unsaved_files_array = (_CXUnsavedFile * len(unsaved_files))()
             for i,(name,value) in enumerate(unsaved_files):
-                if not isinstance(value, str):
+                if hasattr(value, "read"):
                     # FIXME: It would be great to support an efficient version
                     # of this, one day.
                     value = value.read()
-                    print(value)
-                if not isinstance(value, str):
+                value = b(value)
+                if not isinstance(value, bytes):
                     raise TypeError('Unexpected unsaved file contents.')
-                unsaved_files_array[i].name = name
+                unsaved_files_array[i].name = b(name)
                 unsaved_files_array[i].contents = value
                 unsaved_files_array[i].length = len(value)
         ptr = conf.lib.clang_codeCompleteAt(self, path, line, column,
@@ -3363,6 +3499,41 @@ functionList = [
    c_uint),
 ]
 
+# Functions only available in newer libclang, they are registered without
+# compatibility check. Use conf.function_exists() before calling them.
+optionalFunctionList = [
+  ("clang_Cursor_Evaluate",
+   [Cursor],
+   c_void_p),
+
+  ("clang_EvalResult_dispose",
+   [c_void_p]),
+
+  ("clang_EvalResult_getAsDouble",
+   [c_void_p],
+   c_double),
+
+  ("clang_EvalResult_getAsInt",
+   [c_void_p],
+   c_int),
+
+  ("clang_EvalResult_getAsLongLong",
+   [c_void_p],
+   c_longlong),
+
+  ("clang_EvalResult_getAsUnsigned",
+   [c_void_p],
+   c_ulonglong),
+
+  ("clang_EvalResult_getKind",
+   [c_void_p],
+   c_int),
+
+  ("clang_EvalResult_isUnsignedInt",
+   [c_void_p],
+   c_uint),
+]
+
 class LibclangError(Exception):
     def __init__(self, message):
         self.m = message
@@ -3402,11 +3573,42 @@ def register_functions(lib, ignore_errors):
         return register_function(lib, item, ignore_errors)
 
     [register(i) for i in functionList]
+    [register_function(lib, i, True) for i in optionalFunctionList]
+
+class LazyLibrary(object):
+    """Wrap a libclang library instance, registering each function prototype
+    on its first use instead of all of them upfront.
+
+    A function missing from the library raises LibclangError, or
+    AttributeError if errors are ignored or the function is optional, only
+    once it is used.
+    """
+
+    def __init__(self, lib, ignore_errors):
+        self._lib = lib
+        self._prototypes = {}
+        for item in functionList:
+            self._prototypes[item[0]] = (item, ignore_errors)
+        for item in optionalFunctionList:
+            self._prototypes[item[0]] = (item, True)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        prototype = self._prototypes.get(name)
+        if prototype is not None:
+            register_function(self._lib, *prototype)
+        func = getattr(self._lib, name)
+        # later lookups find it without __getattr__
+        setattr(self, name, func)
+        return func
 
 class Config:
     library_path = None
     library_file = None
     compatibility_check = True
+    strict_binding = False
     loaded = False
 
     @staticmethod
@@ -3451,10 +3653,29 @@ class Config:
 
         Config.compatibility_check = check_status
 
+    @staticmethod
+    def set_strict_binding(strict_status):
+        """ Register all function prototypes when loading libclang
+
+        By default each function is bound on its first use, so that loading
+        does not pay for the hundreds of functions a program never calls. In
+        strict mode every function in functionList is bound upfront, and with
+        the compatibility check enabled any missing one fails the load, which
+        is useful for testing the bindings against a libclang version.
+        """
+        if Config.loaded:
+            raise Exception("strict_binding must be set before before " \
+                            "using any other functionalities in libclang.")
+
+        Config.strict_binding = strict_status
+
     @CachedProperty
     def lib(self):
         lib = self.get_cindex_library()
-        register_functions(lib, not Config.compatibility_check)
+        if Config.strict_binding:
+            register_functions(lib, not Config.compatibility_check)
+        else:
+            lib = LazyLibrary(lib, not Config.compatibility_check)
         Config.loaded = True
         return lib
 
@@ -3491,7 +3712,7 @@ class Config:
     def function_exists(self, name):
         try:
             getattr(self.lib, name)
-        except AttributeError:
+        except (AttributeError, LibclangError):
             return False
 
         return True
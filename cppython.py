@@ -9,13 +9,23 @@ from __future__ import unicode_literals
 import sys
 import os
 import re
+import copy
+import time
 import datetime
 import argparse
+import hashlib
+import functools
+import json
 from datetime import datetime
+from array import array
+from collections import OrderedDict
 from contextlib import contextmanager
 from io import BytesIO
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
-from clang.cindex import *
 import clang
 
 __author__ = 'ZHUO Qiang'
@@ -47,201 +57,2023 @@ def parse_type(t):
     # base_type, quanlify, pointer
     return types[-1], quanlify, pointer
     
+
+
+def load_cindex():
+    '''Import clang.cindex, using the libclang beside clang package unless told otherwise
+    '''
+    import clang.cindex
+    config = clang.cindex.Config
+    if not config.loaded and config.library_path is None and config.library_file is None:
+        config.set_library_path(os.path.dirname(clang.__file__))
+    return clang.cindex
+
+
+class LazyModule(object):
+    '''Module loaded by load() on its first attribute access
+    '''
+    def __init__(self, load):
+        self._load = load
+        self._module = None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._module is None:
+            self._module = self._load()
+        value = getattr(self._module, name)
+        setattr(self, name, value)
+        return value
+
+
+# clang.cindex and libclang are only loaded when something is really parsed,
+# so that --help or a run served from cache starts fast
+cindex = LazyModule(load_cindex)
+
+CLANG_ARGS = ['-x', 'c++']
+
+# stub C++ standard headers declaring just the names used in declarations
+STUBS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+STUB_ARGS = ['-nostdinc++', '-isystem', STUBS_DIRECTORY]
+# C++ standard headers, the ones missing from the stubs are only found without them
+CXX_STANDARD_HEADERS = frozenset((
+    'algorithm', 'any', 'array', 'atomic', 'bitset', 'cassert', 'cctype', 'cerrno', 'cfenv', 'cfloat',
+    'charconv', 'chrono', 'cinttypes', 'climits', 'clocale', 'cmath', 'codecvt', 'complex',
+    'condition_variable', 'csetjmp', 'csignal', 'cstdarg', 'cstddef', 'cstdint', 'cstdio', 'cstdlib',
+    'cstring', 'ctime', 'cuchar', 'cwchar', 'cwctype', 'deque', 'exception', 'execution', 'filesystem',
+    'forward_list', 'fstream', 'functional', 'future', 'initializer_list', 'iomanip', 'ios', 'iosfwd',
+    'iostream', 'istream', 'iterator', 'limits', 'list', 'locale', 'map', 'memory', 'memory_resource',
+    'mutex', 'new', 'numeric', 'optional', 'ostream', 'queue', 'random', 'ratio', 'regex',
+    'scoped_allocator', 'set', 'shared_mutex', 'sstream', 'stack', 'stdexcept', 'streambuf', 'string',
+    'string_view', 'system_error', 'thread', 'tuple', 'type_traits', 'typeindex', 'typeinfo',
+    'unordered_map', 'unordered_set', 'utility', 'valarray', 'variant', 'vector'))
+MISSING_HEADER = re.compile(r"'([^']*)' file not found")
+
+def parse_cpp_file(file_path, include_paths=None, index=None, pch=None, macros=True, unsaved_files=None,
+                   preamble=False, extra_args=None):
+    '''Parse C++ header file_path into a translation unit
+
+    unsaved_files is a list of (path, content) whose content is used instead
+    of reading path from disk, file_path itself may be one of them. If
+    preamble is true, the included files are precompiled by the first reparse
+    so that later reparses are faster.
+    '''
+    # TODO add include path
+    args = CLANG_ARGS + list(extra_args or [])
+    options = (
+        cindex.TranslationUnit.PARSE_INCOMPLETE
+        | cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+        | cindex.TranslationUnit.PARSE_INCLUDE_BRIEF_COMMENTS_IN_CODE_COMPLETION # for comment doc
+    )
+    if macros:
+        # for Macro definition, clang records every macro of every included file
+        options |= cindex.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+    if pch:
+        args = args + ['-include-pch', pch]
+    if pch or preamble:
+        options |= cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE
+
+    with profile_phase('parse_cpp_file'):
+        tu = cindex.TranslationUnit.from_source(
+            filename=file_path,
+            args=args,
+            options=options,
+            index=index,
+            unsaved_files=unsaved_files,
+        )
+    return tu
+
+
+def get_mtimes(files):
+    '''Return dict of path -> modification time of files, None if file is missing
+    '''
+    mtimes = {}
+    for path in files:
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def has_stub_errors(tu):
+    '''Whether tu parsed with the stubs has errors caused by them
+
+    That is an error in a stub, a standard header without stub, or a name of
+    std the stubs do not declare. Other errors, like a missing header of the
+    project, are there without the stubs as well.
+    '''
+    for diagnostic in tu.diagnostics:
+        if diagnostic.severity < cindex.Diagnostic.Error:
+            continue
+        location_file = diagnostic.location.file
+        if location_file is not None and os.path.abspath(u(location_file.name)).startswith(STUBS_DIRECTORY + os.sep):
+            return True
+        message = u(diagnostic.spelling)
+        missing = MISSING_HEADER.search(message)
+        if missing is not None and missing.group(1) in CXX_STANDARD_HEADERS:
+            return True
+        if "namespace 'std'" in message:
+            return True
+    return False
+
+
+def get_dependencies(tu):
+    '''Return the main file of translation unit and all the files it includes
+    '''
+    files = [u(tu.spelling)]
+    for i in tu.get_includes():
+        name = u(i.include.name)
+        if name not in files:
+            files.append(name)
+    return files
+
+
+INCLUDE_DIRECTIVE = re.compile(r'^\s*#\s*include\s*([<"])([^>"]*)[>"]')
+
+def get_include_directives(file_path):
+    '''Return (line number, quote, included name) of each #include in file_path
+    '''
+    with open(file_path, 'rb') as f:
+        lines = u(f.read()).splitlines()
+    directives = []
+    for number, line in enumerate(lines, 1):
+        match = INCLUDE_DIRECTIVE.match(line)
+        if match:
+            directives.append((number, match.group(1), match.group(2)))
+    return directives
+
+
+class Session(object):
+    '''Generator session sharing one clang Index among all the translation units it parses
+
+    The Index (and libclang itself) is only loaded by the first parse, so that
+    a session whose headers all hit the cache never touches libclang.
+
+    If pch_directory is given, files included by a header are precompiled into
+    a pch file there, which is reused until any of the included files changes.
+
+    If max_memory is given, check_memory() raises MemoryLimitError once the
+    process uses more than max_memory bytes.
+
+    Content of in-memory headers added by add_unsaved_file() is seen by every
+    translation unit the session parses, no temporary file is written.
+
+    If stubs is true, the C++ standard headers in STUBS_DIRECTORY are parsed
+    instead of the real ones. Header failing to compile because of them, see
+    has_stub_errors(), is parsed again with the real ones, and from then on
+    only with them.
+    '''
+    # whether translation units are parsed to be reparsed later
+    preamble = False
+
+    def __init__(self, pch_directory=None, max_memory=None, stubs=False):
+        self._index = None
+        self.pch_directory = pch_directory
+        self.max_memory = max_memory
+        self.stubs = stubs
+        # absolute paths of headers which do not compile with the stubs
+        self.stub_failures = set()
+        # header -> files its pch depends on
+        self.pch_dependencies = {}
+        # absolute path -> content in bytes
+        self.unsaved_files = {}
+
+    def __getstate__(self):
+        # Index could not be pickled, each process creates its own
+        state = self.__dict__.copy()
+        state['_index'] = None
+        return state
+
+    @property
+    def index(self):
+        if self._index is None:
+            with profile_phase('load libclang'):
+                self._index = cindex.Index.create()
+        return self._index
+
+    def add_unsaved_file(self, path, content):
+        '''Parse content as if it were the file at path
+        '''
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        self.unsaved_files[os.path.abspath(path)] = content
+
+    def remove_unsaved_file(self, path):
+        self.unsaved_files.pop(os.path.abspath(path), None)
+
+    def is_unsaved(self, path):
+        return os.path.abspath(path) in self.unsaved_files
+
+    def get_unsaved_files(self):
+        return list(self.unsaved_files.items()) or None
+
+    def get_args(self):
+        '''Return clang args identifying how headers are parsed
+        '''
+        if self.stubs:
+            return CLANG_ARGS + STUB_ARGS
+        return CLANG_ARGS
+
+    def parse(self, file_path, include_paths=None, macros=True):
+        extra_args = []
+        if self.stubs and os.path.abspath(file_path) not in self.stub_failures:
+            extra_args = STUB_ARGS
+        pch = None
+        if self.is_unsaved(file_path):
+            # clang finds in-memory file by its absolute path
+            file_path = os.path.abspath(file_path)
+        elif self.pch_directory:
+            # include directives of in-memory header are not on disk, it is parsed without pch
+            pch = self.get_pch(file_path, extra_args)
+        tu = parse_cpp_file(file_path, include_paths, index=self.index, pch=pch, macros=macros,
+                            unsaved_files=self.get_unsaved_files(), preamble=self.preamble,
+                            extra_args=extra_args)
+        if extra_args and has_stub_errors(tu):
+            tu.dispose()
+            self.stub_failures.add(os.path.abspath(file_path))
+            with profile_phase('stub fallback'):
+                return self.parse(file_path, include_paths, macros)
+        return tu
+
+    def reparse(self, tu):
+        tu.reparse(self.get_unsaved_files())
+
+    def release(self, tu):
+        '''Called once tu parsed by this session is not needed any more
+        '''
+        tu.dispose()
+
+    def check_memory(self, header):
+        if self.max_memory is None:
+            return
+        used = get_memory_usage()
+        if used is not None and used > self.max_memory:
+            raise MemoryLimitError(header, used, self.max_memory)
+
+    def get_dependencies(self, tu):
+        '''Return all the files tu depends on, including the ones only seen through its pch
+        '''
+        files = get_dependencies(tu)
+        for name in self.pch_dependencies.get(files[0], []):
+            if name not in files:
+                files.append(name)
+        return files
+
+    def get_pch(self, file_path, extra_args=None):
+        '''Return the pch of the files included by file_path, build it if it is missing or outdated
+        '''
+        extra_args = list(extra_args or [])
+        key = hashlib.sha1('\0'.join([__version__, os.path.abspath(file_path)] + CLANG_ARGS + extra_args).encode('utf-8'))
+        pch_path = os.path.join(self.pch_directory, key.hexdigest() + '.pch')
+        stamp_path = pch_path + '.deps'
+        directives = [(quote, name) for (number, quote, name) in get_include_directives(file_path)]
+
+        try:
+            with open(stamp_path, 'rb') as f:
+                stamp = pickle.load(f)
+        except Exception:
+            stamp = None
+        if (stamp is not None and stamp['directives'] == directives and os.path.exists(pch_path)
+            and stamp['digest'] == get_files_digest(stamp['files'])):
+            self.pch_dependencies[file_path] = stamp['files']
+            return pch_path
+
+        if not directives:
+            return None
+        if not os.path.isdir(self.pch_directory):
+            os.makedirs(self.pch_directory)
+
+        # only a real parse knows which includes survive conditional compilation
+        tu = parse_cpp_file(file_path, index=self.index, extra_args=extra_args)
+        main_file = u(tu.spelling)
+        active_lines = set(
+            c.location.line for c in tu.cursor.get_children()
+            if c.kind == cindex.CursorKind.INCLUSION_DIRECTIVE
+            and c.location.file and u(c.location.file.name) == main_file)
+        tu.dispose()
+
+        # prefix header lives in pch directory, quoted includes are made absolute
+        header_directory = os.path.dirname(os.path.abspath(file_path))
+        includes = []
+        for number, quote, name in get_include_directives(file_path):
+            if number not in active_lines:
+                continue
+            path = os.path.join(header_directory, name)
+            if quote == '"' and os.path.exists(path):
+                includes.append('#include "{}"'.format(path))
+            elif quote == '"':
+                includes.append('#include "{}"'.format(name))
+            else:
+                includes.append('#include <{}>'.format(name))
+
+        prefix_path = os.path.join(self.pch_directory, key.hexdigest() + '.hpp')
+        with open(prefix_path, 'wb') as f:
+            f.write(''.join(i + '\n' for i in includes).encode('utf-8'))
+        pch_tu = parse_cpp_file(prefix_path, index=self.index, extra_args=extra_args)
+        temp_path = '{}.{}.tmp'.format(pch_path, os.getpid())
+        pch_tu.save(temp_path)
+        if os.path.exists(pch_path):
+            os.remove(pch_path)
+        os.rename(temp_path, pch_path)
+
+        files = get_dependencies(pch_tu)
+        pch_tu.dispose()
+        with open(stamp_path, 'wb') as f:
+            pickle.dump({'directives': directives, 'files': files, 'digest': get_files_digest(files)},
+                        f, pickle.HIGHEST_PROTOCOL)
+        self.pch_dependencies[file_path] = files
+        return pch_path
+
+
+class ResidentSession(Session):
+    '''Session keeping the translation units it parses alive for a long running process
+
+    Parsing a header again returns its kept translation unit, which is only
+    reparsed if any file it depends on has changed since. Reparse reuses the
+    precompiled preamble of the included files. At most max_units translation
+    units are kept, least recently used ones are disposed.
+    '''
+    preamble = True
+
+    def __init__(self, pch_directory=None, max_memory=None, stubs=False, max_units=32):
+        super(ResidentSession, self).__init__(pch_directory, max_memory, stubs)
+        self.max_units = max_units
+        # (path, macros, stubs) -> (translation unit, mtimes of its dependencies), least recently used first
+        self.units = OrderedDict()
+
+    def __getstate__(self):
+        state = super(ResidentSession, self).__getstate__()
+        state['units'] = OrderedDict()
+        return state
+
+    def parse(self, file_path, include_paths=None, macros=True):
+        key = (os.path.abspath(file_path), macros, self.stubs)
+        entry = self.units.pop(key, None)
+        if entry is None:
+            tu = super(ResidentSession, self).parse(file_path, include_paths, macros)
+        else:
+            tu, mtimes = entry
+            if get_mtimes(self.get_dependencies(tu)) != mtimes:
+                pch_files = self.pch_dependencies.get(file_path, [])
+                if any(get_mtimes(pch_files).get(f) != mtimes.get(f) for f in pch_files):
+                    # pch is outdated, parse from scratch to rebuild it
+                    tu.dispose()
+                    tu = super(ResidentSession, self).parse(file_path, include_paths, macros)
+                else:
+                    with profile_phase('reparse'):
+                        self.reparse(tu)
+        self.units[key] = (tu, get_mtimes(self.get_dependencies(tu)))
+
+        while len(self.units) > self.max_units:
+            self.units.popitem(last=False)[1][0].dispose()
+        return tu
+
+    def release(self, tu):
+        # kept until evicted
+        pass
+
+    def clear(self):
+        while self.units:
+            self.units.popitem()[1][0].dispose()
+
+
+class MemoryLimitError(Exception):
+    '''Raised once generating header makes the process use more memory than allowed
+    '''
+    def __init__(self, header, used, limit):
+        super(MemoryLimitError, self).__init__(header, used, limit)
+        self.header = header
+        self.used = used
+        self.limit = limit
+
+    def __str__(self):
+        return '{} needs {:.0f} MB of memory, more than the limit of {:.0f} MB'.format(
+            self.header, self.used / 1048576.0, self.limit / 1048576.0)
+
+
+def get_memory_usage():
+    '''Return the resident memory of this process in bytes, None if it is unknown
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak instead of current, in bytes on Mac OS and KB elsewhere
+    used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return used if sys.platform == 'darwin' else used * 1024
+
+
+_default_session = None
+
+def get_default_session():
+    '''Return the session shared by the whole process, e.g. a worker of parse_headers
+    '''
+    global _default_session
+    if _default_session is None:
+        _default_session = Session()
+    return _default_session
+
+
+def set_default_session(session):
+    global _default_session
+    _default_session = session
+
+
+class Profiler(object):
+    '''Wall time, CPU time and peak memory of generation phases
+
+    A phase run several times adds up its times and keeps its highest peak.
+    Peak memory is the most traced by tracemalloc (python 3) above the memory
+    in use when the phase begins, None if tracemalloc is not available.
+    Tracing started by the profiler is stopped by close().
+    '''
+    def __init__(self, trace_memory=True):
+        self.phases = []
+        # phase name -> {'wall', 'cpu', 'peak', 'count'}
+        self.results = {}
+        self.clock = getattr(time, 'process_time', None) or time.clock
+        self.tracemalloc = None
+        # whether tracing was started here and is to be stopped by close()
+        self.started_tracing = False
+        if trace_memory:
+            try:
+                import tracemalloc
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started_tracing = True
+                self.tracemalloc = tracemalloc
+            except ImportError:
+                pass
+        # [memory in use at begin, peak so far] of the running phases
+        self.memory_stack = []
+
+    def close(self):
+        if self.started_tracing:
+            self.tracemalloc.stop()
+            self.started_tracing = False
+        self.tracemalloc = None
+
+    @contextmanager
+    def phase(self, name):
+        start = self.begin()
+        try:
+            yield
+        finally:
+            self.end(name, start)
+
+    def begin(self):
+        '''Start timing a phase, return what end() takes
+        '''
+        tracer = self.tracemalloc
+        if tracer is not None:
+            current, peak = tracer.get_traced_memory()
+            if self.memory_stack:
+                self.memory_stack[-1][1] = max(self.memory_stack[-1][1], peak)
+            if hasattr(tracer, 'reset_peak'):
+                tracer.reset_peak()
+            self.memory_stack.append([current, current])
+        return time.time(), self.clock()
+
+    def end(self, name, start):
+        wall, cpu = time.time() - start[0], self.clock() - start[1]
+        peak = None
+        tracer = self.tracemalloc
+        if tracer is not None and self.memory_stack:
+            begin, peak = self.memory_stack.pop()
+            peak = max(peak, tracer.get_traced_memory()[1])
+            if self.memory_stack:
+                self.memory_stack[-1][1] = max(self.memory_stack[-1][1], peak)
+            peak -= begin
+        self.add(name, wall, cpu, peak)
+
+    def add(self, name, wall, cpu, peak=None):
+        result = self.results.get(name)
+        if result is None:
+            self.phases.append(name)
+            result = self.results[name] = {'wall': 0.0, 'cpu': 0.0, 'peak': peak, 'count': 0}
+        result['wall'] += wall
+        result['cpu'] += cpu
+        result['count'] += 1
+        if peak is not None and peak > result['peak']:
+            result['peak'] = peak
+
+    def report(self, file=None):
+        file = file or sys.stdout
+        print('{:<32}{:>8}{:>12}{:>12}{:>12}'.format('phase', 'count', 'wall ms', 'cpu ms', 'peak KB'), file=file)
+        for name in self.phases:
+            result = self.results[name]
+            peak = '-' if result['peak'] is None else '{:.1f}'.format(result['peak'] / 1024.0)
+            print('{:<32}{:>8}{:>12.1f}{:>12.1f}{:>12}'.format(
+                name, result['count'], result['wall'] * 1000, result['cpu'] * 1000, peak), file=file)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump([dict(self.results[i], phase=i) for i in self.phases], f, indent=2)
+
+
+_profiler = None
+
+def set_profiler(profiler):
+    '''Profile the phases of generation with profiler, None to stop
+
+    The profiler replaced is closed, its results are kept.
+    '''
+    global _profiler
+    if _profiler is not None and _profiler is not profiler:
+        _profiler.close()
+    _profiler = profiler
+
+
+@contextmanager
+def profile_phase(name):
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.phase(name):
+            yield
+
+    
+def get_proxy_name(name):
+    return name + '_proxy'
+    
+    
+def get_brief_comment(cursor, encoding='utf-8'):
+    # TODO add docstring from comment
+    return cursor.brief_comment.decode(encoding).strip().strip('/').strip()
+    
+def get_raw_comment(cursor, encoding='utf-8'):
+    # TODO add docstring from comment
+    try: 
+        comment = cursor.raw_comment.decode(encoding)
+    except UnicodeDecodeError:
+        comment = cursor.raw_comment.decode('gbk')
+    return '\n'.join(line.strip().strip('/').strip() for line in comment.split('\n'))
+
+
+class CachedSlot(object):
+    '''Like clang.cindex.CachedProperty, for classes with __slots__, the value is kept in slot "_" + name
+    '''
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.slot = '_' + wrapped.__name__
+        self.__doc__ = wrapped.__doc__
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.slot)
+        except AttributeError:
+            value = self.wrapped(instance)
+            setattr(instance, self.slot, value)
+            return value
+
+
+class CursorSnapshot(object):
+    '''Properties of a cursor AstTable.append() needs, each fetched from libclang once
+
+    Strings are already decoded.
+    '''
+    FIELDS = ('kind', 'spelling', 'type', 'type_spelling', 'underlying_type_spelling', 'result_type_spelling',
+              'access', 'arguments', 'method_type', 'is_definition', 'is_pod', 'enum_value')
+    __slots__ = ('cursor',) + tuple('_' + i for i in FIELDS)
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @CachedSlot
+    def kind(self):
+        return self.cursor.kind
+
+    @CachedSlot
+    def spelling(self):
+        return u(self.cursor.spelling)
+
+    @CachedSlot
+    def type(self):
+        return self.cursor.type
+
+    @CachedSlot
+    def type_spelling(self):
+        return u(self.type.spelling)
+
+    @CachedSlot
+    def underlying_type_spelling(self):
+        if self.kind != cindex.CursorKind.TYPEDEF_DECL:
+            return None
+        return u(self.cursor.underlying_typedef_type.spelling)
+
+    @CachedSlot
+    def result_type_spelling(self):
+        if self.kind not in (cindex.CursorKind.CXX_METHOD, cindex.CursorKind.FUNCTION_DECL):
+            return None
+        return u(self.cursor.result_type.spelling)
+
+    @CachedSlot
+    def access(self):
+        '''public, protected, private or invalid, in lower case
+        '''
+        return self.cursor.access_specifier.name.lower()
+
+    @CachedSlot
+    def arguments(self):
+        '''[(type, name)] of function, method or constructor
+        '''
+        if self.kind not in (cindex.CursorKind.CXX_METHOD, cindex.CursorKind.FUNCTION_DECL, cindex.CursorKind.CONSTRUCTOR):
+            return []
+        return [(u(i.type.spelling), u(i.spelling)) for i in self.cursor.get_arguments()]
+
+    @CachedSlot
+    def method_type(self):
+        '''static, pure, virtual or empty string
+        '''
+        if self.kind != cindex.CursorKind.CXX_METHOD:
+            return ''
+        if self.cursor.is_static_method():
+            return 'static'
+        elif self.cursor.is_pure_virtual_method():
+            return 'pure'
+        elif self.cursor.is_virtual_method():
+            return 'virtual'
+        return ''
+
+    @CachedSlot
+    def is_definition(self):
+        return self.cursor.is_definition()
+
+    @CachedSlot
+    def is_pod(self):
+        return self.type.is_pod()
+
+    @CachedSlot
+    def enum_value(self):
+        if self.kind != cindex.CursorKind.ENUM_CONSTANT_DECL:
+            return None
+        return self.cursor.enum_value
+
+
+INTEGER_LITERAL = re.compile(r'^(0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)(?:[uU]?[lL]{0,2}|[lL]{1,2}[uU])$')
+
+def parse_integer_literal(spelling):
+    match = INTEGER_LITERAL.match(spelling)
+    if match is None:
+        return None
+    digits = match.group(1)
+    if digits[:2] in ('0x', '0X'):
+        return int(digits, 16)
+    if digits[:2] in ('0b', '0B'):
+        return int(digits[2:], 2)
+    if len(digits) > 1 and digits[0] == '0':
+        return int(digits, 8)
+    return int(digits)
+
+
+# (bits, unsigned) of C integer types, long is 64 bits as on LP64 platforms
+C_INT = (32, False)
+C_UNSIGNED_INT = (32, True)
+C_LONG = (64, False)
+C_UNSIGNED_LONG = (64, True)
+
+# binary operator -> precedence, higher binds tighter
+C_BINARY_OPERATORS = {
+    '||': 1, '&&': 2, '|': 3, '^': 4, '&': 5, '==': 6, '!=': 6,
+    '<': 7, '>': 7, '<=': 7, '>=': 7, '<<': 8, '>>': 8,
+    '+': 9, '-': 9, '*': 10, '/': 10, '%': 10,
+}
+
+
+def get_literal_types(spelling):
+    '''Return the C types integer literal spelling could have, in the order the first fitting one is picked
+    '''
+    suffix = spelling.lstrip('0123456789abcdefABCDEFxXbB').lower()
+    decimal = spelling[0] != '0' or spelling == '0' + suffix
+    if 'u' in suffix:
+        return [C_UNSIGNED_INT, C_UNSIGNED_LONG] if 'l' not in suffix else [C_UNSIGNED_LONG]
+    if 'l' in suffix:
+        return [C_LONG, C_UNSIGNED_LONG]
+    if decimal:
+        return [C_INT, C_LONG, C_UNSIGNED_LONG]
+    return [C_INT, C_UNSIGNED_INT, C_LONG, C_UNSIGNED_LONG]
+
+
+def fit_integer(value, types):
+    '''Return (value, type) of the first C type in types which could represent value
+    '''
+    for bits, unsigned in types:
+        if (0 <= value < 1 << bits) if unsigned else (-(1 << (bits - 1)) <= value < 1 << (bits - 1)):
+            return value, (bits, unsigned)
+    raise ValueError(value)
+
+
+def convert_integer(value, type):
+    '''Return value converted to C type, wrapping around like two's complement does
+    '''
+    bits, unsigned = type
+    value &= (1 << bits) - 1
+    if not unsigned and value >> (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def get_common_type(a, b):
+    '''Return the type usual arithmetic conversions give to operands of types a and b
+    '''
+    if a[1] == b[1]:
+        return max(a, b)
+    unsigned, signed = (a, b) if a[1] else (b, a)
+    # signed type wins only if it is wider
+    return signed if signed[0] > unsigned[0] else unsigned
+
+
+class IntegerExpression(object):
+    '''Evaluate C integer constant expression given as token spellings
+
+    Operators have their C precedence, and values their C type: result of
+    ``~0u`` is 4294967295, division truncates toward zero. ValueError is
+    raised for anything else, like casts, sizeof or unknown identifiers.
+    '''
+    def __init__(self, tokens, names):
+        self.tokens = list(tokens)
+        self.names = names
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError(token)
+        self.position += 1
+        return token
+
+    def evaluate(self):
+        value, type = self.conditional()
+        if self.peek() is not None:
+            raise ValueError(self.peek())
+        return value
+
+    def conditional(self):
+        condition = self.binary(1)
+        if self.peek() != '?':
+            return condition
+        self.take('?')
+        a = self.conditional()
+        self.take(':')
+        b = self.conditional()
+        type = get_common_type(a[1], b[1])
+        return convert_integer((a if condition[0] else b)[0], type), type
+
+    def binary(self, precedence):
+        left = self.unary()
+        while C_BINARY_OPERATORS.get(self.peek(), 0) >= precedence:
+            operator = self.take()
+            right = self.binary(C_BINARY_OPERATORS[operator] + 1)
+            left = self.apply_binary(operator, left, right)
+        return left
+
+    def unary(self):
+        token = self.take()
+        if token in ('+', '-', '~', '!'):
+            value, type = self.unary()
+            if token == '!':
+                return int(not value), C_INT
+            value = {'+': value, '-': -value, '~': ~value}[token]
+            return convert_integer(value, type), type
+        if token == '(':
+            value = self.conditional()
+            self.take(')')
+            return value
+        if INTEGER_LITERAL.match(token):
+            return fit_integer(parse_integer_literal(token), get_literal_types(token))
+        if token in self.names:
+            return fit_integer(self.names[token], [C_INT, C_LONG, C_UNSIGNED_LONG])
+        raise ValueError(token)
+
+    def apply_binary(self, operator, left, right):
+        if operator in ('&&', '||'):
+            if operator == '&&':
+                return int(bool(left[0]) and bool(right[0])), C_INT
+            return int(bool(left[0]) or bool(right[0])), C_INT
+        if operator in ('<<', '>>'):
+            value, type = left
+            if not 0 <= right[0] < type[0]:
+                raise ValueError(right[0])
+            return convert_integer(value << right[0] if operator == '<<' else value >> right[0], type), type
+
+        type = get_common_type(left[1], right[1])
+        a, b = convert_integer(left[0], type), convert_integer(right[0], type)
+        if operator in ('==', '!=', '<', '>', '<=', '>='):
+            result = {'==': a == b, '!=': a != b, '<': a < b, '>': a > b, '<=': a <= b, '>=': a >= b}[operator]
+            return int(result), C_INT
+        if operator in ('/', '%'):
+            if b == 0:
+                raise ValueError(b)
+            quotient = abs(a) // abs(b)
+            if (a < 0) != (b < 0):
+                quotient = -quotient
+            value = quotient if operator == '/' else a - b * quotient
+        else:
+            value = {'+': a + b, '-': a - b, '*': a * b, '&': a & b, '|': a | b, '^': a ^ b}[operator]
+        return convert_integer(value, type), type
+
+
+def eval_integer_expression(tokens, names=None):
+    '''Evaluate C integer expression given as token spellings
+
+    Identifiers are looked up in names. Return None if it is not an integer
+    constant expression IntegerExpression supports.
+    '''
+    if not tokens:
+        return None
+    try:
+        return IntegerExpression(tokens, names or {}).evaluate()
+    except ValueError:
+        return None
+
+
+class ConstantEvaluator(object):
+    '''Evaluate value of const int variables and macros in a translation unit
+
+    Variables are evaluated by libclang evaluation API when it is available.
+    Otherwise, and for macros, at most max_tokens tokens of the definition
+    are scanned, so integer expressions like ``1 << 4`` or ``FOO | BAR`` are
+    evaluated as well, referring to constants evaluated before them. If that
+    fails, the first literal is used as before. Longer definition is unknown,
+    its value is None. Values are strings.
+    '''
+    def __init__(self, max_tokens=64):
+        self.max_tokens = max_tokens
+        # constant name -> int value, for expressions referring to them
+        self.names = {}
+
+    def define(self, name, value):
+        self.names[name] = value
+
+    def evaluate(self, cursor):
+        if not isinstance(cursor, CursorSnapshot):
+            cursor = CursorSnapshot(cursor)
+        if cursor.kind == cindex.CursorKind.MACRO_DEFINITION:
+            value = self.evaluate_macro(cursor)
+        else:
+            value = self.evaluate_variable(cursor)
+
+        if isinstance(value, (int, type(sys.maxsize + 1))):
+            self.define(cursor.spelling, value)
+            value = str(value)
+        return value
+
+    def get_tokens(self, cursor):
+        '''Return kinds, decoded spellings and extents of at most max_tokens tokens, None if there are more
+        '''
+        kinds, spellings, extents = cursor.cursor.get_token_data(self.max_tokens + 1)
+        if len(kinds) > self.max_tokens:
+            return None
+        return kinds, [u(i) for i in spellings], extents
+
+    def evaluate_variable(self, cursor):
+        value = cursor.cursor.evaluate()
+        if value is not None:
+            return value
+
+        tokens = self.get_tokens(cursor)
+        if tokens is None:
+            return None
+        kinds, spellings, extents = tokens
+        if '=' not in spellings:
+            return None
+        begin = spellings.index('=') + 1
+        end = spellings.index(';', begin) if ';' in spellings[begin:] else len(spellings)
+        value = eval_integer_expression(spellings[begin:end], self.names)
+        if value is None:
+            return get_first_literal(kinds, spellings)
+        return value
+
+    def evaluate_macro(self, cursor):
+        tokens = self.get_tokens(cursor)
+        if tokens is None:
+            return None
+        kinds, spellings, extents = tokens
+        if len(spellings) < 2:
+            return None
+        # function like macro has "(" right after its name
+        if spellings[1] == '(' and extents[1].start.offset == extents[0].end.offset:
+            return None
+
+        kinds, spellings = kinds[1:], spellings[1:]
+        if (len(spellings) == 1 and kinds[0] == cindex.TokenKind.LITERAL
+            and parse_integer_literal(spellings[0]) is None):
+            # char, string and float literal is kept as it is
+            return spellings[0]
+        value = eval_integer_expression(spellings, self.names)
+        if value is None:
+            return get_first_literal(kinds, spellings)
+        return value
+
+
+def get_first_literal(kinds, spellings):
+    for kind, spelling in zip(kinds, spellings):
+        if kind == cindex.TokenKind.LITERAL:
+            return spelling
+            
+
+def split_namespace_name(namespace_name):
+    all = namespace_name.split('::')
+    namespaces, name = all[:-1], all[-1]
+    name = name.replace(' &', '')
+    return name, namespaces
+
+def is_const_int(type):
+    return type.is_const_qualified() and type.kind in (
+        cindex.TypeKind.SHORT, cindex.TypeKind.INT, cindex.TypeKind.LONG, cindex.TypeKind.LONGLONG, cindex.TypeKind.INT128,
+        cindex.TypeKind.USHORT, cindex.TypeKind.UINT, cindex.TypeKind.ULONG, cindex.TypeKind.ULONGLONG, cindex.TypeKind.UINT128)
+            
+            
+def get_compound_typedef_name(compound_type, next_cursor):
+    if (next_cursor and next_cursor.kind == cindex.CursorKind.TYPEDEF_DECL
+        and '{} {}'.format(compound_type, next_cursor.spelling) == next_cursor.underlying_type_spelling):
+        return next_cursor.spelling
     
+        
+class CursorFilter(object):
+    '''Decide which cursors apply() walks into
+
+    paths is the allow-list of header files and directories, cursors located in
+    any other file are skipped together with their children. Cursors without
+    location, e.g. builtin macros, are kept.
+
+    macros is one of MACRO_MODES: 'off' exports no macro at all, 'main' only
+    the ones defined in the main file of translation unit and 'all' every
+    accepted one. If macro_regex is given, macro name must also match it.
+
+    If main_files is set, 'main' macros are the ones defined in any of these
+    files instead, see parse_umbrella(). Cursors located in excluded files are
+    skipped even if they are allowed, see for_header().
+
+    namespaces, include and exclude select entities by qualified name like
+    ``foo::Bar``. Only namespaces listed in namespaces, their parents and
+    children are walked into and only entities inside them are kept.
+    Declarations in global scope or a namespace must match one of the include
+    regular expressions, and no declaration, including class members, may
+    match any exclude one. Expressions match the whole qualified name.
+    '''
+    MACRO_MODES = ('off', 'main', 'all')
+
+    def __init__(self, paths=None, macros='all', macro_regex=None,
+                 namespaces=None, include=None, exclude=None):
+        if macros not in self.MACRO_MODES:
+            raise ValueError('unknown macro mode: {}'.format(macros))
+        self.paths = sorted(set(os.path.abspath(p) for p in paths or []))
+        self.macros = macros
+        self.macro_regex = macro_regex
+        self.macro_pattern = re.compile(macro_regex) if macro_regex else None
+        self.namespaces = sorted(set(i.strip(':') for i in namespaces or []))
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        # anchored like re.fullmatch, which python 2 does not have
+        self.include_patterns = [re.compile(r'(?:{})\Z'.format(i)) for i in self.include]
+        self.exclude_patterns = [re.compile(r'(?:{})\Z'.format(i)) for i in self.exclude]
+        # file name -> accepted or not
+        self.files = {}
+        # absolute paths of main files, None for the main file of translation unit
+        self.main_files = None
+        # absolute paths of files skipped anyway
+        self.excluded = []
+
+    def key(self):
+        '''Return strings identifying this filter, for cache key
+        '''
+        key = ['--allow=' + p for p in self.paths] + ['--macros=' + self.macros]
+        if self.macro_regex:
+            key.append('--macro-regex=' + self.macro_regex)
+        key += ['--only-namespace=' + i for i in self.namespaces]
+        key += ['--include-entity=' + i for i in self.include]
+        key += ['--exclude-entity=' + i for i in self.exclude]
+        key += ['--exclude-file=' + p for p in self.excluded]
+        return key
+
+    def for_header(self, header, headers):
+        '''Return the filter of the translation unit of header, one of the target headers
+
+        Entities of the other target headers are wrapped by their own pxd, the
+        translation unit of header skips them even if it includes them.
+        '''
+        cursor_filter = copy.copy(self)
+        path = os.path.abspath(header)
+        if cursor_filter.paths and path not in cursor_filter.paths:
+            cursor_filter.paths = sorted(cursor_filter.paths + [path])
+        cursor_filter.excluded = sorted(set(os.path.abspath(h) for h in headers) - set([path]))
+        cursor_filter.files = {}
+        return cursor_filter
+
+    def selects_entities(self):
+        '''Whether entities are filtered by qualified name
+        '''
+        return bool(self.namespaces or self.include or self.exclude)
+
+    def accept_namespace(self, name):
+        return not self.namespaces or any(
+            name == i or name.startswith(i + '::') or i.startswith(name + '::') for i in self.namespaces)
+
+    def accept_entity(self, name, scope, member=False):
+        '''Whether entity qualified name declared in scope, a namespace or class, is kept
+        '''
+        if self.namespaces and not any(scope == i or scope.startswith(i + '::') for i in self.namespaces):
+            return False
+        if any(p.match(name) for p in self.exclude_patterns):
+            return False
+        if not member and self.include_patterns:
+            return any(p.match(name) for p in self.include_patterns)
+        return True
+
+    def wants_macros(self):
+        '''Whether macro definitions need to be recorded while parsing
+        '''
+        return self.macros != 'off'
+
+    def accept_macro(self, cursor, name):
+        if self.macros == 'off':
+            return False
+        if self.macro_pattern is not None and not self.macro_pattern.match(name):
+            return False
+        if self.macros == 'main':
+            location_file = cursor.location.file
+            if location_file is not None and self.main_files is not None:
+                return os.path.abspath(u(location_file.name)) in self.main_files
+            return (location_file is not None
+                    and u(location_file.name) == u(cursor.translation_unit.spelling))
+        return True
+
+    def accept_file(self, name):
+        accepted = self.files.get(name)
+        if accepted is None:
+            path = os.path.abspath(u(name))
+            accepted = path not in self.excluded and (not self.paths or any(
+                path == p or path.startswith(p.rstrip(os.sep) + os.sep) for p in self.paths))
+            self.files[name] = accepted
+        return accepted
+
+    def accept(self, cursor):
+        if not self.paths and not self.excluded:
+            return True
+        location_file = cursor.location.file
+        if location_file is None:
+            return True
+        return self.accept_file(location_file.name)
+
+        
+CLANG_DEFAULT_ENTITIES = ('__int128_t', '__uint128_t', '__builtin_va_list')
+
+# names of cursor kinds apply() walks into
+CONTAINER_KINDS = ('TRANSLATION_UNIT', 'NAMESPACE', 'STRUCT_DECL', 'CLASS_DECL', 'ENUM_DECL')
+
+# names of cursor kinds selected by CursorFilter.accept_entity
+ENTITY_KINDS = (
+    'STRUCT_DECL', 'CLASS_DECL', 'ENUM_DECL', 'TYPEDEF_DECL', 'VAR_DECL', 'FIELD_DECL',
+    'CXX_METHOD', 'FUNCTION_DECL', 'CONSTRUCTOR')
+
+
+def get_walk_filter(cursor_filter):
+    '''Return enter(child, parent) of Cursor.visit_subtree selecting the descendants apply() needs
+    '''
+    container_kinds = tuple(getattr(cindex.CursorKind, i) for i in CONTAINER_KINDS)
+    entity_kinds = tuple(getattr(cindex.CursorKind, i) for i in ENTITY_KINDS)
+    selects_entities = cursor_filter.selects_entities()
+    # hash of namespace, class and struct -> its qualified name
+    scopes = {}
+
+    def enter(child, parent):
+        parent_kind = parent.kind
+        if parent_kind == cindex.CursorKind.TRANSLATION_UNIT:
+            if not cursor_filter.accept(child) or u(child.spelling) in CLANG_DEFAULT_ENTITIES:
+                return None
+        elif parent_kind == cindex.CursorKind.NAMESPACE:
+            if not cursor_filter.accept(child):
+                return None
+
+        kind = child.kind
+        if selects_entities and parent_kind != cindex.CursorKind.ENUM_DECL:
+            scope = scopes.get(parent.hash, '')
+            name = u(child.spelling)
+            qualified_name = scope + '::' + name if scope else name
+            if kind == cindex.CursorKind.NAMESPACE:
+                if not cursor_filter.accept_namespace(qualified_name):
+                    return None
+            elif kind in entity_kinds and name:
+                member = parent_kind in (cindex.CursorKind.CLASS_DECL, cindex.CursorKind.STRUCT_DECL)
+                if not cursor_filter.accept_entity(qualified_name, scope, member):
+                    return None
+            if kind in (cindex.CursorKind.NAMESPACE, cindex.CursorKind.CLASS_DECL, cindex.CursorKind.STRUCT_DECL):
+                scopes[child.hash] = qualified_name
+        return kind in container_kinds
+    return enter
+
+
+# AstTable.access
+ACCESS_NAMES = ('invalid', 'public', 'protected', 'private', 'none')
+
+
+def new_column(typecode):
+    # typecode must not be unicode for python 2
+    return array(str(typecode))
+
+
+def get_scope_name(cursor):
+    '''Return qualified name of the namespace or class cursor is declared in, empty in global scope
+    '''
+    names = []
+    parent = cursor.semantic_parent
+    while parent is not None and parent.kind != cindex.CursorKind.TRANSLATION_UNIT:
+        names.append(u(parent.spelling))
+        parent = parent.semantic_parent
+    return '::'.join(reversed(names))
+
+
+class AstTable(object):
+    '''Struct-of-arrays table of the cursors apply() walks, one row per cursor
+
+    Rows are in preorder, a row's descendants are the rows up to its end.
+    Names, type spellings, file names and constant values are interned in
+    strings and refered by id, -1 for none. Type is the type of field, the
+    underlying type of typedef or the result type of function. Value is the
+    evaluated value of constant and macro. Arguments of row i are the
+    argument rows between arguments[i-1] and arguments[i]. Usr and scope are
+    the clang USR and the qualified name of the semantic parent of class,
+    struct, enum and typedef.
+
+    No cursor is kept, so the translation unit could go once the table is built.
+    '''
+    DEFINITION = 1
+    POD = 2
+    STATIC = 4
+    PURE = 8
+    VIRTUAL = 16
+    # const int variable and macro to export
+    CONSTANT = 32
+
+    COLUMNS = ('kind', 'parent', 'end', 'name', 'type', 'access', 'flags', 'file', 'line', 'value', 'arguments',
+               'usr', 'scope')
+    ARGUMENT_COLUMNS = ('argument_type', 'argument_name')
+
+    def __init__(self):
+        for name in self.COLUMNS + self.ARGUMENT_COLUMNS:
+            setattr(self, name, new_column('i'))
+        self.access = new_column('b')
+        self.strings = []
+        # string -> id
+        self.string_ids = {}
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __eq__(self, other):
+        return (isinstance(other, AstTable) and self.strings == other.strings and
+                all(getattr(self, i) == getattr(other, i) for i in self.COLUMNS + self.ARGUMENT_COLUMNS))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['string_ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.string_ids = dict((s, i) for (i, s) in enumerate(self.strings))
+
+    def intern(self, string):
+        if string is None:
+            return -1
+        id = self.string_ids.get(string)
+        if id is None:
+            id = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return id
+
+    def string(self, id):
+        if id < 0:
+            return None
+        return self.strings[id]
+
+    def get_arguments(self, row):
+        begin = self.arguments[row - 1] if row else 0
+        return [(self.strings[self.argument_type[i]], self.strings[self.argument_name[i]])
+                for i in range(begin, self.arguments[row])]
+
+    def row(self, row):
+        return AstRow(self, row)
+
+    def append(self, child, parent, end, cursor_filter, evaluator):
+        '''Append the row of CursorSnapshot child, fetching only what its kind needs
+        '''
+        CursorKind = cindex.CursorKind
+        kind = child.kind
+        name = type = value = usr = scope = None
+        access = flags = 0
+        arguments = []
+
+        if kind in (CursorKind.TYPEDEF_DECL, CursorKind.ENUM_DECL, CursorKind.STRUCT_DECL, CursorKind.CLASS_DECL):
+            usr = u(child.cursor.get_usr())
+            scope = get_scope_name(child.cursor)
+        if kind == CursorKind.TYPEDEF_DECL:
+            type = child.underlying_type_spelling
+        elif kind == CursorKind.ENUM_CONSTANT_DECL:
+            evaluator.define(child.spelling, child.enum_value)
+            value = str(child.enum_value)
+        elif kind == CursorKind.VAR_DECL:
+            if is_const_int(child.type):
+                flags |= self.CONSTANT
+                value = evaluator.evaluate(child)
+        elif kind == CursorKind.MACRO_DEFINITION:
+            name = child.spelling
+            if (not name.startswith('_') and name not in ('OBJC_NEW_PROPERTIES',)
+                and cursor_filter.accept_macro(child.cursor, name)):
+                flags |= self.CONSTANT
+                value = evaluator.evaluate(child)
+        elif kind in (CursorKind.STRUCT_DECL, CursorKind.CLASS_DECL):
+            if child.is_definition:
+                flags |= self.DEFINITION
+            if child.is_pod:
+                flags |= self.POD
+        elif kind == CursorKind.FIELD_DECL:
+            type = child.type_spelling
+            access = ACCESS_NAMES.index(child.access)
+        elif kind in (CursorKind.CXX_METHOD, CursorKind.FUNCTION_DECL, CursorKind.CONSTRUCTOR):
+            type = child.result_type_spelling
+            arguments = child.arguments
+            if kind == CursorKind.CXX_METHOD:
+                access = ACCESS_NAMES.index(child.access)
+                flags |= {'static': self.STATIC, 'pure': self.PURE, 'virtual': self.VIRTUAL}.get(child.method_type, 0)
+        elif kind not in (CursorKind.TRANSLATION_UNIT, CursorKind.NAMESPACE,
+                          CursorKind.ENUM_DECL):
+            # nothing else is needed for the cursors apply() ignores
+            name = ''
+
+        if name is None:
+            name = child.spelling
+        file_name, line = None, 0
+        # top level anonymous struct needs its file to be routed as well, see apply()
+        if kind != CursorKind.TRANSLATION_UNIT and (
+                name or parent == 0 and kind in (CursorKind.STRUCT_DECL, CursorKind.CLASS_DECL, CursorKind.ENUM_DECL)):
+            location = child.cursor.location
+            if location.file is not None:
+                file_name, line = u(location.file.name), location.line
+
+        self.kind.append(kind.value)
+        self.parent.append(parent)
+        self.end.append(end)
+        self.name.append(self.intern(name))
+        self.type.append(self.intern(type))
+        self.access.append(access)
+        self.flags.append(flags)
+        self.file.append(self.intern(file_name))
+        self.line.append(line)
+        self.value.append(self.intern(value))
+        for argument_type, argument_name in arguments:
+            self.argument_type.append(self.intern(argument_type))
+            self.argument_name.append(self.intern(argument_name))
+        self.arguments.append(len(self.argument_type))
+        self.usr.append(self.intern(usr))
+        self.scope.append(self.intern(scope))
+
+    def send_symbol(self, visitor, row, name):
+        '''Send the USR and qualified name of entity row named name
+        '''
+        scope = self.strings[self.scope[row]]
+        visitor.on_symbol(self.strings[self.usr[row]], scope + '::' + name if scope else name)
+
+    def apply(self, visitor, route=None):
+        '''Send the visitor events of all rows to visitor
+
+        If route is given, events of each top level entity go to the visitor
+        route(name of the file declaring it, None if there is no file) returns
+        instead, None for visitor, and the translation unit itself sends no event.
+        '''
+        default_visitor = visitor
+        CursorKind = cindex.CursorKind
+        strings = self.strings
+        kinds, names, types, flags, ends = self.kind, self.name, self.type, self.flags, self.end
+        private = ACCESS_NAMES.index('private')
+
+        # (end row, visitor call) of the rows being walked into
+        ends_stack = []
+        # rows of typedef already consumed by an anonymous struct
+        consumed = set()
+        row = 0
+        while row < len(kinds):
+            while ends_stack and ends_stack[-1][0] == row:
+                ends_stack.pop()[1]()
+            if row in consumed:
+                row += 1
+                continue
+
+            kind = CursorKind.from_id(kinds[row])
+            name = strings[names[row]]
+            end = ends[row]
+            current = row
+            # walk into children by default, set to end to skip them
+            row += 1
+
+            if route is not None and self.parent[current] == 0:
+                visitor = route(self.string(self.file[current])) or default_visitor
+
+            if kind == CursorKind.TRANSLATION_UNIT:
+                if route is None:
+                    visitor.on_file_begin(name)
+                    ends_stack.append((end, visitor.on_file_end))
+
+            elif kind == CursorKind.NAMESPACE:
+                visitor.on_namespace_begin(name)
+                ends_stack.append((end, functools.partial(visitor.on_namespace_end, name)))
+
+            elif kind == CursorKind.TYPEDEF_DECL:
+                self.send_symbol(visitor, current, name)
+                visitor.on_typedef(name, strings[types[current]])
+
+            elif kind == CursorKind.ENUM_DECL:
+                enum_constants = [(strings[names[i]], int(strings[self.value[i]]))
+                                  for i in range(row, end)
+                                  if kinds[i] == CursorKind.ENUM_CONSTANT_DECL.value]
+                if enum_constants:
+                    self.send_symbol(visitor, current, name)
+                    visitor.on_enum(name, enum_constants)
+                row = end
+
+            elif kind == CursorKind.VAR_DECL and flags[current] & self.CONSTANT:
+                visitor.on_const_int(name, self.string(self.value[current]))
+
+            elif kind == CursorKind.MACRO_DEFINITION and flags[current] & self.CONSTANT:
+                visitor.on_macro_value(name, self.string(self.value[current]))
+
+            elif kind in (CursorKind.STRUCT_DECL, CursorKind.CLASS_DECL):
+                compound_name = 'struct' if kind == CursorKind.STRUCT_DECL else 'class'
+                typedef = False
+                if not name:
+                    # the sibling right after the struct, if any
+                    parent_end = ends_stack[-1][0] if ends_stack else len(kinds)
+                    next_child = self.row(end) if end < parent_end else None
+                    name = get_compound_typedef_name(compound_name, next_child)
+                    if name:
+                        typedef = True
+                        consumed.add(end)
+                    else:
+                        row = end
+                        continue # discard struct with no name
+
+                definition = flags[current] & self.DEFINITION
+                if flags[current] & self.POD:
+                    if definition:
+                        self.send_symbol(visitor, current, name)
+                        visitor.on_pod_begin(compound_name, name, typedef)
+                        ends_stack.append((end, functools.partial(visitor.on_pod_end, name)))
+                    else:
+                        visitor.on_pod_declaration(compound_name, name, typedef)
+                        row = end
+                else:
+                    if definition:
+                        self.send_symbol(visitor, current, name)
+                        visitor.on_class_begin(compound_name, name, typedef)
+                        ends_stack.append((end, functools.partial(visitor.on_class_end, name)))
+                    else:
+                        visitor.on_class_declaration(compound_name, name, typedef)
+                        row = end
+
+            elif kind == CursorKind.FIELD_DECL:
+                if self.access[current] != private:
+                    visitor.on_field(name, strings[types[current]])
+
+            elif kind == CursorKind.CXX_METHOD:
+                if self.access[current] != private:
+                    entity = self.row(current)
+                    visitor.on_method(name, strings[types[current]], self.get_arguments(current),
+                                      entity.access, entity.method_type, entity)
+
+            elif kind == CursorKind.FUNCTION_DECL:
+                visitor.on_function(name, strings[types[current]], self.get_arguments(current))
+
+            elif kind == CursorKind.CONSTRUCTOR:
+                visitor.on_constructor(name, self.get_arguments(current))
+
+        while ends_stack:
+            ends_stack.pop()[1]()
+
+
+class AstRow(object):
+    '''View of one row of AstTable, with the same properties as CursorSnapshot
+    '''
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def kind(self):
+        return cindex.CursorKind.from_id(self.table.kind[self.index])
+
+    @property
+    def spelling(self):
+        return self.table.string(self.table.name[self.index])
+
+    @property
+    def type_spelling(self):
+        if self.kind != cindex.CursorKind.FIELD_DECL:
+            return None
+        return self.table.string(self.table.type[self.index])
+
+    @property
+    def underlying_type_spelling(self):
+        if self.kind != cindex.CursorKind.TYPEDEF_DECL:
+            return None
+        return self.table.string(self.table.type[self.index])
+
+    @property
+    def result_type_spelling(self):
+        if self.kind not in (cindex.CursorKind.CXX_METHOD, cindex.CursorKind.FUNCTION_DECL):
+            return None
+        return self.table.string(self.table.type[self.index])
+
+    @property
+    def access(self):
+        return ACCESS_NAMES[self.table.access[self.index]]
+
+    @property
+    def arguments(self):
+        return self.table.get_arguments(self.index)
+
+    @property
+    def method_type(self):
+        flags = self.table.flags[self.index]
+        for flag, name in ((AstTable.STATIC, 'static'), (AstTable.PURE, 'pure'), (AstTable.VIRTUAL, 'virtual')):
+            if flags & flag:
+                return name
+        return ''
+
+    @property
+    def is_definition(self):
+        return bool(self.table.flags[self.index] & AstTable.DEFINITION)
+
+    @property
+    def is_pod(self):
+        return bool(self.table.flags[self.index] & AstTable.POD)
+
+    @property
+    def location(self):
+        '''(file name, line)
+        '''
+        return self.table.string(self.table.file[self.index]), self.table.line[self.index]
+
+
+def build_ast_table(children, cursor_filter=None, evaluator=None):
+    '''Walk children once and return their AstTable
+
+    Row of each cursor is appended while it is visited, see get_walk_filter()
+    for which cursors are, so that no cursor is kept once its row is appended.
+    '''
+    if cursor_filter is None:
+        cursor_filter = CursorFilter()
+    if evaluator is None:
+        evaluator = ConstantEvaluator()
+
+    container_kinds = tuple(getattr(cindex.CursorKind, i) for i in CONTAINER_KINDS)
+    accept = get_walk_filter(cursor_filter)
+    table = AstTable()
+    # rows of the cursors whose children are being visited
+    parents = []
+
+    def append(cursor, parent, walk_into):
+        row = len(table)
+        # end of container is known once its children are appended
+        table.append(CursorSnapshot(cursor), parent, row + 1, cursor_filter, evaluator)
+        if walk_into:
+            parents.append(row)
+
+    def enter(child, parent):
+        walk_into = accept(child, parent)
+        if walk_into is not None:
+            append(child, parents[-1], walk_into)
+        return walk_into
+
+    def leave(cursor):
+        row = parents.pop()
+        table.end[row] = len(table)
+
+    for cursor in children:
+        walk_into = cursor.kind in container_kinds
+        append(cursor, -1, walk_into)
+        if walk_into:
+            cursor.visit_subtree(enter, leave)
+            leave(cursor)
+    return table
+
+
+def apply(children, visitor, cursor_filter=None, evaluator=None):
+    with profile_phase('apply'):
+        build_ast_table(children, cursor_filter, evaluator).apply(visitor)
+
+
+class VisitorGroup(object):
+    '''Send every visitor event to all the visitors
+
+    Handlers of each event are resolved once into a dispatcher kept as the
+    attribute of the same name, so that sending an event is one call per
+    visitor. Handlers of BaseVisitor doing nothing are not called at all.
+    Events of visitors whose class does not define them, like EventRecorder,
+    are resolved the first time they are sent.
+    '''
+    def __init__(self, visitors, profiler=None):
+        self.visitors = list(visitors)
+        # time spent by each visitor is added to profiler if given
+        self.profiler = profiler
+        names = set(name for visitor in self.visitors for name in dir(type(visitor)) if name.startswith('on_'))
+        for name in names:
+            if all(hasattr(visitor, name) for visitor in self.visitors):
+                setattr(self, name, self.get_dispatcher(name))
+
+    def get_dispatcher(self, name):
+        handlers = [(visitor, getattr(visitor, name)) for visitor in self.visitors]
+        handlers = [(v, h) for (v, h) in handlers if getattr(h, 'noop', False) is not True]
+        if self.profiler is not None:
+            return self.get_profiled_dispatcher(handlers)
+        handlers = tuple(h for (v, h) in handlers)
+        if not handlers:
+            return noop_dispatcher
+        if len(handlers) == 1:
+            return handlers[0]
+
+        def dispatch(*l, **kw):
+            for handler in handlers:
+                handler(*l, **kw)
+        return dispatch
+
+    def get_profiled_dispatcher(self, handlers):
+        begin, end = self.profiler.begin, self.profiler.end
+        handlers = tuple(('visitor ' + type(visitor).__name__, handler) for visitor, handler in handlers)
+
+        def dispatch(*l, **kw):
+            for phase, handler in handlers:
+                start = begin()
+                try:
+                    handler(*l, **kw)
+                finally:
+                    end(phase, start)
+        return dispatch
+
+    def __getattr__(self, name):
+        if name.startswith('__') or not name.startswith('on_'):
+            raise AttributeError(name)
+        dispatcher = self.get_dispatcher(name)
+        setattr(self, name, dispatcher)
+        return dispatcher
+
+    def replay(self, events):
+        '''Send recorded events in one batch
+        '''
+        dispatchers = self.__dict__
+        for name, l in events:
+            dispatcher = dispatchers.get(name)
+            if dispatcher is None:
+                dispatcher = getattr(self, name)
+            dispatcher(*l)
+
+
+def noop_dispatcher(*l, **kw):
+    pass
+
+
+def noop_handler(method):
+    '''Mark visitor method doing nothing, VisitorGroup skips it unless it is overridden
+    '''
+    method.noop = True
+    return method
+
+
+class EventRecorder(object):
+    '''Record visitor events so that they could be cached and replayed later
+    '''
+    def __init__(self):
+        self.events = []
+
+    def on_method(self, name, return_type, parameters, access, method_type, cursor, *l, **kw):
+        # cursor snapshot refers to the translation unit, could not outlive it
+        self.events.append(('on_method', (name, return_type, parameters, access, method_type, None)))
+
+    def __getattr__(self, name):
+        if not name.startswith('on_'):
+            raise AttributeError(name)
+
+        def record(*l):
+            self.events.append((name, l))
+
+        return record
+
+
+def replay(events, visitor):
+    if isinstance(visitor, VisitorGroup):
+        visitor.replay(events)
+        return
+    for name, l in events:
+        getattr(visitor, name)(*l)
+
+
+def get_files_digest(files):
+    digest = hashlib.sha1()
+    for path in files:
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except (IOError, OSError):
+            return None
+        digest.update(path.encode('utf-8'))
+        digest.update(hashlib.sha1(content).digest())
+    return digest.hexdigest()
+
+
+class HeaderCache(object):
+    '''On-disk cache of the visitor events of parsed header
+
+    Entry is looked up by header path, clang args and cppython version, and is
+    only valid while the content of the header and all the files it includes
+    stay the same. Least recently used entries are evicted once the total size
+    exceeds max_size bytes.
+    '''
+    def __init__(self, directory, max_size=256*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def entry_path(self, header, args):
+        key = hashlib.sha1('\0'.join([__version__, os.path.abspath(header)] + list(args)).encode('utf-8'))
+        return os.path.join(self.directory, key.hexdigest() + '.cache')
+
+    def get(self, header, args):
+        path = self.entry_path(header, args)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            return None
+
+        if entry['digest'] is None or entry['digest'] != get_files_digest(entry['files']):
+            return None
+
+        # mtime is the access time used by LRU eviction
+        os.utime(path, None)
+        return entry['events']
+
+    def put(self, header, args, files, events):
+        path = self.entry_path(header, args)
+        entry = {'files': files, 'digest': get_files_digest(files), 'events': events}
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        # cache may be shared by several processes, entries could disappear at any time
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for (mtime, size, name) in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def get_symbols(events):
+    '''Return symbols of the entities declared by events of one header
+
+    Symbol is a tuple (usr, kind, qualified name, name, pxd, header), kind is
+    'class', 'pod', 'enum' or 'typedef', name is how cython refers to it in
+    pxd, like Outer.Inner for nested class, and pxd is the name the pxd of the
+    header is cimported as. USR and qualified name are sent by on_symbol
+    right before the event declaring the entity.
+    '''
+    symbols = []
+    # names of the classes being declared
+    classes = []
+    header = pxd = symbol = None
+    for name, args in events:
+        if name == 'on_file_begin':
+            header = args[0]
+            pxd = os.path.splitext(os.path.basename(header))[0]
+        elif name == 'on_symbol':
+            symbol = args
+        elif name in ('on_class_begin', 'on_pod_begin', 'on_enum', 'on_typedef'):
+            if name in ('on_class_begin', 'on_pod_begin'):
+                entity = args[1]
+                kind = 'class' if name == 'on_class_begin' else 'pod'
+            else:
+                entity = args[0]
+                kind = 'enum' if name == 'on_enum' else 'typedef'
+            if symbol is not None:
+                usr, qualified_name = symbol
+                symbols.append((usr, kind, qualified_name, '.'.join(classes + [entity]), pxd, header))
+            symbol = None
+            if kind in ('class', 'pod'):
+                classes.append(entity)
+        elif name in ('on_class_end', 'on_pod_end'):
+            classes.pop()
+    return symbols
+
+
+def get_type_name(typename):
+    '''Return qualified name of the type typename refers to, e.g. foo::Bar of const foo::Bar &
+    '''
+    return ' '.join(i for i in typename.replace('*', ' ').replace('&', ' ').split()
+                    if i not in ('const', 'volatile', 'struct', 'class', 'enum', 'union'))
+
+
+class SymbolIndex(object):
+    '''On-disk index of the entities wrapped by generated modules, keyed by clang USR
+
+    Module generated later resolves the types it uses but does not declare
+    itself by an indexed lookup, so that it cimports the pxd of the module
+    wrapping them instead of parsing that module's headers again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+
+    def __getstate__(self):
+        # connection could not be pickled, each process opens its own
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # not needed unless there is an index
+            import sqlite3
+            # modules of a batch could update the index at the same time
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS symbols (usr TEXT PRIMARY KEY, kind TEXT, qualified_name TEXT, '
+                'name TEXT, module TEXT, directory TEXT, pxd TEXT, header TEXT)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS symbols_qualified_name ON symbols (qualified_name)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS symbols_module ON symbols (module, directory)')
+            self._connection.commit()
+        return self._connection
+
+    def update(self, module, directory, symbols):
+        '''Replace the symbols of module generated in directory
+        '''
+        directory = os.path.abspath(directory)
+        with self.connection:
+            self.connection.execute('DELETE FROM symbols WHERE module = ? AND directory = ?', (module, directory))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(usr, kind, qualified_name, name, module, directory, pxd, os.path.abspath(header))
+                 for (usr, kind, qualified_name, name, pxd, header) in symbols])
+
+    def lookup(self, qualified_name, kinds=('class', 'pod', 'enum', 'typedef')):
+        '''Return (usr, kind, qualified name, name, module, directory, pxd, header) of the entity, None if unknown
+
+        Only entities of kinds are looked up.
+        '''
+        return self.connection.execute(
+            'SELECT * FROM symbols WHERE qualified_name = ? AND kind IN ({})'.format(', '.join('?' for i in kinds)),
+            (qualified_name,) + tuple(kinds)).fetchone()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def get_foreign_types(events_list, symbols):
+    '''Return dict of qualified name -> (pxd, name in pxd, module directory) of the types used by events but wrapped by other modules
+    '''
+    declared = set()
+    used = set()
+    for events in events_list:
+        declared.update(i[2] for i in get_symbols(events))
+        for name, args in events:
+            if name in ('on_function', 'on_method'):
+                used.add(args[1])
+                used.update(t for (t, n) in args[2])
+            elif name == 'on_constructor':
+                used.update(t for (t, n) in args[1])
+            elif name == 'on_field':
+                used.add(args[1])
+
+    foreign = {}
+    for typename in sorted(used):
+        qualified_name = get_type_name(typename)
+        if qualified_name in declared:
+            continue
+        # struct named by typedef is a typedef as well
+        symbol = symbols.lookup(qualified_name, ('class', 'pod'))
+        if symbol is not None:
+            foreign[qualified_name] = (symbol[6], symbol[3], symbol[5])
+    return foreign
+
+
+def parse_events(header, cache=None, session=None, cursor_filter=None):
+    '''Parse header and return its visitor events, using cache if provided
+    '''
+    if session is None:
+        session = get_default_session()
+    key_args = session.get_args()
+    if cursor_filter is not None:
+        key_args = key_args + cursor_filter.key()
+    if session.is_unsaved(header):
+        # in-memory header has no file to check the cache entry against
+        cache = None
+    if cache is not None:
+        events = cache.get(header, key_args)
+        if events is not None:
+            return events
+
+    tu = session.parse(header, macros=cursor_filter is None or cursor_filter.wants_macros())
+    try:
+        events = record_events(tu, cursor_filter)
+        # checked while the translation unit is still in memory
+        session.check_memory(header)
+        files = session.get_dependencies(tu)
+    finally:
+        # events are plain data, the translation unit is not needed any more
+        session.release(tu)
+    if cache is not None:
+        cache.put(header, key_args, files, events)
+    return events
+
+
+def record_events(tu, cursor_filter=None):
+    recorder = EventRecorder()
+    apply([tu.cursor], recorder, cursor_filter)
+    return recorder.events
+
+
+def get_umbrella_path(headers):
+    '''Return path of the in-memory umbrella header including headers, beside the first one
+    '''
+    key = hashlib.sha1('\0'.join(os.path.abspath(h) for h in headers).encode('utf-8'))
+    return os.path.join(os.path.dirname(os.path.abspath(headers[0])),
+                        'cppython_umbrella_{}.hpp'.format(key.hexdigest()[:12]))
+
+
+def get_file_owners(tu, headers):
+    '''Return function of file name -> the header in headers including it first, None if no one does
+    '''
+    owners = dict((os.path.abspath(h), h) for h in headers)
+    # included file -> file including it first
+    includers = {}
+    for i in tu.get_includes():
+        includers.setdefault(os.path.abspath(u(i.include.name)), os.path.abspath(u(i.source.name)))
+
+    def get_owner(name):
+        if name is None:
+            return None
+        path = os.path.abspath(name)
+        if path not in owners:
+            includer = includers.get(path)
+            # guard against include cycle
+            includers[path] = None
+            owners[path] = get_owner(includer)
+        return owners[path]
+    return get_owner
+
+
+def parse_umbrella(headers, cache=None, session=None, cursor_filter=None):
+    '''Parse headers as one translation unit, return their events in the same order as headers
+
+    The translation unit is an in-memory umbrella header including all the
+    headers, so that the files they share are parsed only once. Entities are
+    routed to the header declaring them, the ones of other allowed files to
+    the header which includes them first. Macros of 'main' mode are the ones
+    defined in any of the headers.
+    '''
+    if session is None:
+        session = get_default_session()
+    if cursor_filter is None:
+        cursor_filter = CursorFilter()
+    umbrella = get_umbrella_path(headers)
+    key_args = session.get_args() + cursor_filter.key() + ['--umbrella'] + [os.path.abspath(h) for h in headers]
+    if any(session.is_unsaved(h) for h in headers):
+        cache = None
+    if cache is not None:
+        events_list = cache.get(umbrella, key_args)
+        if events_list is not None:
+            return events_list
+
+    cursor_filter = copy.copy(cursor_filter)
+    cursor_filter.main_files = set(os.path.abspath(h) for h in headers)
+    recorders = [EventRecorder() for h in headers]
+    session.add_unsaved_file(umbrella, ''.join('#include "{}"\n'.format(os.path.abspath(h)) for h in headers))
+    try:
+        tu = session.parse(umbrella, macros=cursor_filter.wants_macros())
+    finally:
+        # only the umbrella translation unit includes it, later parses of the session do not see it
+        session.remove_unsaved_file(umbrella)
+    try:
+        get_owner = get_file_owners(tu, headers)
+        routes = dict(zip(headers, recorders))
+        for header, recorder in routes.items():
+            # the same file name a translation unit of header alone has
+            recorder.on_file_begin(os.path.abspath(header) if session.is_unsaved(header) else header)
+        with profile_phase('apply'):
+            build_ast_table([tu.cursor], cursor_filter).apply(
+                recorders[0], lambda name: routes.get(get_owner(name)))
+        for recorder in recorders:
+            recorder.on_file_end()
+        session.check_memory(umbrella)
+        # the first one is the umbrella itself
+        files = [f for f in session.get_dependencies(tu)[1:] if not session.is_unsaved(f)]
+    finally:
+        session.release(tu)
+    events_list = [recorder.events for recorder in recorders]
+    if cache is not None:
+        cache.put(umbrella, key_args, files, events_list)
+    return events_list
+
 
-# Assume clang lib is beside clang package
-Config.set_library_path(os.path.dirname(clang.__file__))
+def parse_events_of(arguments):
+    '''parse_events(*arguments), for process pool
+    '''
+    return parse_events(*arguments)
 
-def parse_cpp_file(file_path, include_paths=None):
-    # TODO add include path
-    tu = TranslationUnit.from_source(
-        filename=file_path,
-        args=['-x', 'c++'],
-        options=(
-            TranslationUnit.PARSE_INCOMPLETE
-            | TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
-            | TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD # for Macro definition
-            | TranslationUnit.PARSE_INCLUDE_BRIEF_COMMENTS_IN_CODE_COMPLETION # for comment doc
-        ),
-    )
-    return tu
 
-    
-def get_proxy_name(name):
-    return name + '_proxy'
-    
-    
-def pairwise(iterable):
-    iterable = iter(iterable)
-    last = next(iterable)
-    for i in iterable:
-        yield last, i
-        last = i
-    yield last, None
-    
-def get_brief_comment(cursor, encoding='utf-8'):
-    # TODO add docstring from comment
-    return cursor.brief_comment.decode(encoding).strip().strip('/').strip()
-    
-def get_raw_comment(cursor, encoding='utf-8'):
-    # TODO add docstring from comment
-    try: 
-        comment = cursor.raw_comment.decode(encoding)
-    except UnicodeDecodeError:
-        comment = cursor.raw_comment.decode('gbk')
-    return '\n'.join(line.strip().strip('/').strip() for line in comment.split('\n'))
+def parse_headers(headers, cache=None, jobs=None, session=None, cursor_filter=None):
+    '''Parse headers in a process pool, return their events in the same order as headers
 
-    
-def get_literal(cursor):
-    for t in cursor.get_tokens():
-        if t.kind == TokenKind.LITERAL:
-            return u(t.spelling)
-            # return ast.literal_eval(t.spelling)
-            
+    Each worker process parses with its own copy of session. Translation unit
+    of each header is filtered by cursor_filter.for_header().
+    '''
+    # not needed by most runs, importing it is not free either
+    import multiprocessing
 
-def split_namespace_name(namespace_name):
-    all = namespace_name.split('::')
-    namespaces, name = all[:-1], all[-1]
-    name = name.replace(' &', '')
-    return name, namespaces
+    if session is None:
+        session = get_default_session()
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(headers))
+    filters = [cursor_filter and cursor_filter.for_header(h, headers) for h in headers]
+    if jobs <= 1:
+        return [parse_events(h, cache, session, f) for h, f in zip(headers, filters)]
 
-def is_const_int(type):
-    return type.is_const_qualified() and type.kind in (
-        TypeKind.SHORT, TypeKind.INT, TypeKind.LONG, TypeKind.LONGLONG, TypeKind.INT128,
-        TypeKind.USHORT, TypeKind.UINT, TypeKind.ULONG, TypeKind.ULONGLONG, TypeKind.UINT128)
-            
-            
-def get_compound_typedef_name(compound_type, next_cursor):
-    if (next_cursor and next_cursor.kind == CursorKind.TYPEDEF_DECL
-        and '{} {}'.format(compound_type, u(next_cursor.spelling)) == u(next_cursor.underlying_typedef_type.spelling)):
-        return u(next_cursor.spelling)
-    
-        
-def apply(children, visitor):
-    lookahead_children = pairwise(children)
-    for child, next_child in lookahead_children:
-        if child.kind == CursorKind.TRANSLATION_UNIT:
-            filename = u(child.spelling)
-            visitor.on_file_begin(filename)
-
-            CLANG_DEFAULT_ENTITIES = ('__int128_t', '__uint128_t', '__builtin_va_list')
-            children = (c for c in child.get_children() if u(c.spelling) not in CLANG_DEFAULT_ENTITIES)
-            apply(children, visitor)
-            visitor.on_file_end()
-
-        if child.kind == CursorKind.NAMESPACE and child.get_children():
-            visitor.on_namespace_begin(u(child.spelling))
-            apply(child.get_children(), visitor)
-            visitor.on_namespace_end(u(child.spelling))
-
-        elif child.kind == CursorKind.TYPEDEF_DECL:
-            visitor.on_typedef(u(child.spelling), u(child.underlying_typedef_type.spelling))
-
-        elif child.kind == CursorKind.ENUM_DECL:
-            enum_typename = u(child.spelling)
-            enum_constants = [(u(c.spelling), c.enum_value)
-                              for c in child.get_children()
-                              if c.kind == CursorKind.ENUM_CONSTANT_DECL]
-            if enum_constants:
-                visitor.on_enum(enum_typename, enum_constants)
-
-        elif child.kind == CursorKind.VAR_DECL and is_const_int(child.type):
-            visitor.on_const_int(u(child.spelling), get_literal(child))
-
-        elif child.kind == CursorKind.MACRO_DEFINITION:
-            name = u(child.spelling)
-            if not name.startswith('_') and name not in ('OBJC_NEW_PROPERTIES',):
-                visitor.on_macro_value(name, get_literal(child))
+    pool = multiprocessing.Pool(jobs, set_default_session, (session,))
+    try:
+        # worker parses with its default session
+        return pool.map(parse_events_of, [(h, cache, None, f) for h, f in zip(headers, filters)])
+    finally:
+        pool.close()
+        pool.join()
 
-        elif child.kind in (CursorKind.STRUCT_DECL, CursorKind.CLASS_DECL):
-            compound_name = 'struct' if child.kind == CursorKind.STRUCT_DECL else 'class'
-            name = u(child.spelling)
-            typedef = False
-            if not name:
-                name = get_compound_typedef_name(compound_name, next_child)
-                if name:
-                    typedef = True
-                    next(lookahead_children)
-                else:
-                    continue # discard struct with no name
-                
-            if child.type.is_pod():
-                if child.is_definition():
-                    visitor.on_pod_begin(compound_name, name, typedef)
-                    apply(child.get_children(), visitor)
-                    visitor.on_pod_end(name)
-                else:
-                    visitor.on_pod_declaration(compound_name, name, typedef)
-            else:
-                if child.is_definition():
-                    visitor.on_class_begin(compound_name, name, typedef)
-                    apply(child.get_children(), visitor)
-                    visitor.on_class_end(name)
-                else:
-                    visitor.on_class_declaration(compound_name, name, typedef)
-
-        elif child.kind == CursorKind.FIELD_DECL:
-            if child.access_specifier.name != 'PRIVATE':
-                name = u(child.spelling)
-                visitor.on_field(name, u(child.type.spelling))
-
-        elif child.kind == CursorKind.CXX_METHOD:
-            if child.access_specifier.name != 'PRIVATE':
-                name = u(child.spelling)
-                access = child.access_specifier.name.lower()
-                return_type = u(child.result_type.spelling)
-                parameters = [(u(i.type.spelling), u(i.spelling)) for i in child.get_arguments()]
-                method_type = ''
-                if child.is_static_method():
-                    method_type = 'static'
-                elif child.is_pure_virtual_method():
-                    method_type = 'pure'
-                elif child.is_virtual_method():
-                    method_type = 'virtual'
-                visitor.on_method(name, return_type, parameters, access, method_type, child)
-                
-        elif child.kind == CursorKind.FUNCTION_DECL:
-            name = u(child.spelling)
-            return_type = u(child.result_type.spelling)
-            parameters = [(u(i.type.spelling), u(i.spelling)) for i in child.get_arguments()]
-            visitor.on_function(name, return_type, parameters)
-            
-        elif child.kind == CursorKind.CONSTRUCTOR:
-            name = u(child.spelling)
-            parameters = [(u(i.type.spelling), u(i.spelling)) for i in child.get_arguments()]        
-            visitor.on_constructor(name, parameters)
-            
-        else:
-            # print child.kind, child.spelling, child.type.spelling
-            pass
-        
-    
-class VisitorGroup(object):
-    def __init__(self, visitors):
-        self.visitors = list(visitors)
 
-    def __getattr__(self, name):
-        def method(*l, **kw):
-            for visitor in self.visitors:
-                getattr(visitor, name)(*l, **kw)
-                
-        return method
-        
-        
 class IndentFile(object):
-    def __init__(self, path=None, indent='    '):
-        if path:
+    def __init__(self, path=None, indent='    ', in_memory=False):
+        self.path = path
+        if path and not in_memory:
             self.file = open(path, 'wb')
         else:
             self.file = BytesIO()
         self.indent = indent
         self.level = 0
+        self.value = None
         
     def close(self):
         if not self.file.closed:
+            if isinstance(self.file, BytesIO):
+                self.value = self.file.getvalue()
             self.file.close()
         self.level = 0
 
+    def getvalue(self):
+        '''Return content written to memory, available after close as well
+        '''
+        if self.file.closed:
+            return self.value
+        return self.file.getvalue()
+
     def reset_indent(self, level=0):
         if level == 0:
             level = -self.level
@@ -263,7 +2095,7 @@ class IndentFile(object):
         
     @property
     def name(self):
-        return self.file.name
+        return self.path
         
     
     
@@ -277,66 +2109,142 @@ def indent(visitor):
         
     
 class BaseVisitor(object):
-    def __init__(self, name, directory, time=None):
-        if time is None:
-            self.time = datetime.now()
-
+    def __init__(self, name, directory, time=None, outputs=None):
+        self.time = time or datetime.now()
         self.name = name
-        if not time:
-            self.time = datetime.now()
         self.directory = directory
-        if not os.path.isdir(self.directory):
+        # generated files are kept in outputs dict as path -> content instead of written
+        self.outputs = outputs
+        if outputs is None and not os.path.isdir(self.directory):
             os.makedirs(self.directory)
         self.content_after_begin = False        
         self.banner = 'Generated by cppython v{} at {} for {} module'.format(__version__, self.time.isoformat(), self.name)
+        self.headers = None
+        # qualified name -> (pxd, name in pxd, directory) of types wrapped by other modules
+        self.foreign_types = {}
         
+    def open_file(self, path):
+        return IndentFile(path, in_memory=self.outputs is not None)
+
     def done(self):
         if 'file' in self.__dict__:
             self.file.close()
+            if self.outputs is not None:
+                self.outputs[self.file.name] = self.file.getvalue()
         
+    def on_module_begin(self, headers):
+        self.headers = list(headers)
+
+    def on_foreign_types(self, types):
+        self.foreign_types = types
+
+    def get_foreign_type(self, typename, spelling=None):
+        '''Return typename qualified by the pxd declaring it if it is wrapped by another module
+
+        spelling is the type as spelled by clang if typename is stripped of its namespace.
+        '''
+        foreign = self.foreign_types.get(get_type_name(typename if spelling is None else spelling))
+        if foreign is None:
+            return typename
+        for name in typename.split():
+            if name not in ('const', 'volatile'):
+                break
+        # namespace is not known by cython
+        return typename.replace(name, '{}.{}'.format(foreign[0], foreign[1]), 1)
+
+    def cimport_foreign_types(self):
+        for pxd in sorted(set(i[0] for i in self.foreign_types.values())):
+            self.file.line('cimport {}', pxd)
+
+    @noop_handler
+    def on_symbol(self, usr, qualified_name):
+        pass
+
+    @noop_handler
+    def on_module_end(self):
+        pass
+
+    @noop_handler
     def on_pod_declaration(self, compound_name, name, typedef):
         pass
 
+    @noop_handler
     def on_class_declaration(self, compound_name, name, typedef):
         pass
 
+    @noop_handler
     def on_macro_value(self, *l, **kw):
         pass
 
+    @noop_handler
     def on_enum(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_typedef(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_pod_begin(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_field(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_pod_end(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_class_begin(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_method(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_class_end(self, *l, **kw):
         pass
     
+    @noop_handler
     def on_file_end(self, *l, **kw):
         pass
     
         
+class ModuleVisitor(BaseVisitor):
+    '''Base of visitors generating one file for the whole module
+
+    The file is begun with the first header and ended with the last one. Headers
+    of the module are known from on_module_begin, otherwise there is only one.
+    '''
+
+    def on_file_begin(self, filename):
+        self.import_name = os.path.splitext(os.path.basename(filename))[0]
+        if 'file' not in self.__dict__:
+            self.begin_module(self.headers or [filename])
+
+    def on_file_end(self):
+        if self.headers is None:
+            self.end_module()
+
+    def on_module_end(self):
+        self.end_module()
+
+    def begin_module(self, headers):
+        pass
+
+    def end_module(self):
+        self.done()
+
+
 class PxdVisitor(BaseVisitor):
     '''Generate pxd file exporting C++ header declaration in cython
     '''
     
-    def __init__(self, name, directory='.', time=None):
-        super(PxdVisitor, self).__init__(name, directory, time)
+    def __init__(self, name, directory='.', time=None, outputs=None):
+        super(PxdVisitor, self).__init__(name, directory, time, outputs)
         self.namespaces = []
         self.content_after_begin = False
         self.class_name = None
@@ -345,12 +2253,13 @@ class PxdVisitor(BaseVisitor):
         # TODO Add file header
         
         name = os.path.join(self.directory, os.path.splitext(os.path.basename(filename))[0] + '.pxd')
-        self.file = IndentFile(name)
+        self.file = self.open_file(name)
         self.header_file_path = os.path.relpath(filename, self.directory)
         
         self.file.line("'''{}'''", self.banner)
         self.file.line('from libcpp cimport bool')
         self.file.line('from cpython.ref cimport PyObject')
+        self.cimport_foreign_types()
         
         # "nogil" quanlifier marks all entities (function, member function) nogil
         # so that they could be called "with nogil:" later
@@ -422,7 +2331,7 @@ class PxdVisitor(BaseVisitor):
         self.class_name = None
         
     def on_field(self, name, typename):
-        self.file.line('{} {}', typename, name)
+        self.file.line('{} {}', self.get_foreign_type(typename), name)
         self.content_after_begin = True
         
     def on_constructor(self, name, parameters):
@@ -433,40 +2342,44 @@ class PxdVisitor(BaseVisitor):
         
     def on_function(self, name, return_type, parameters):
         # parameters_list = ', '.join('{} {}'.format(t, n) for (t, n) in parameters)
-        parameters_list = ', '.join('{} {}'.format(split_namespace_name(t)[0], n) for (t, n) in parameters)        
+        parameters_list = ', '.join('{} {}'.format(self.get_foreign_type(split_namespace_name(t)[0], t), n)
+                                    for (t, n) in parameters)
         return_name, namespaces = split_namespace_name(return_type)
+        return_name = self.get_foreign_type(return_name, return_type)
         self.file.line('cdef {} {}({}) nogil except +', return_name, name, parameters_list)
         
         
-class PxdProxyVisitor(BaseVisitor):
+class PxdProxyVisitor(ModuleVisitor):
     '''Generate pxd file exporting C++ proxy header declaration in cython
     '''
     
-    def __init__(self, name, directory='.', time=None):
-        super(PxdProxyVisitor, self).__init__(name, directory, time)
+    def __init__(self, name, directory='.', time=None, outputs=None):
+        super(PxdProxyVisitor, self).__init__(name, directory, time, outputs)
         self.namespaces = []
         self.content_after_begin = False
         self.class_name = None
         self.constructors = set()
-        self.class_names = set()
-        self.pod_names = set()
+        # name -> import name of the header defining it
+        self.class_names = {}
+        self.pod_names = {}
         
-    def on_file_begin(self, filename):
+    def begin_module(self, headers):
         # TODO Add file header
         
-        self.file = IndentFile(os.path.join(self.directory, self.name+'_cppython.pxd'))
+        self.file = self.open_file(os.path.join(self.directory, self.name+'_cppython.pxd'))
         self.header_file_path = self.name+'_cppython.hpp'
-        self.import_name = os.path.basename(os.path.splitext(filename)[0])
         
         self.file.line("'''{}'''", self.banner)
         self.file.line('from libcpp cimport bool')
         self.file.line('from cpython.ref cimport PyObject')
-        self.file.line('cimport {}', self.import_name)        
+        for header in headers:
+            self.file.line('cimport {}', os.path.basename(os.path.splitext(header)[0]))
+        self.cimport_foreign_types()
         self.file.line('cdef extern from "{}" nogil:', self.header_file_path)
         self.file.reset_indent(1)
         self.content_after_begin = False
         
-    def on_file_end(self):
+    def end_module(self):
         if not self.content_after_begin:
             self.file.line('pass')
         self.done()
@@ -490,29 +2403,30 @@ class PxdProxyVisitor(BaseVisitor):
         pass
         
     def on_pod_begin(self, kind, name, typedef):
-        self.pod_names.add(name)        
+        self.pod_names[name] = self.import_name
         
     def on_pod_end(self, name):
         pass
         
     def on_class_begin(self, kind, name, typedef):
-        self.class_names.add(name)
+        self.class_names[name] = self.import_name
         self.class_name = get_proxy_name(name)
         self.file.line('cdef cppclass {}({}.{}):', self.class_name, self.import_name, name)
         self.file.reset_indent(1)
         
     def on_constructor(self, name, parameters):
         self.constructors.add(name)
-        parameters = [(split_namespace_name(t)[0], n) for (t, n) in parameters]
-        parameters_list = ', '.join('{} {}'.format(self.get_use_type(t), n) for (t, n) in parameters)
+        parameters_list = ', '.join('{} {}'.format(self.get_use_type(split_namespace_name(t)[0], t), n)
+                                    for (t, n) in parameters)
         self.file.line('{}(PyObject* self_object, {})', self.class_name, parameters_list)
         
-    def get_use_type(self, typename):
+    def get_use_type(self, typename, spelling=None):
         name = typename.split()[0]
-        if name in self.class_names or name in self.pod_names:
-            return typename.replace(name, '{}.{}'.format(self.import_name, name))
+        import_name = self.class_names.get(name) or self.pod_names.get(name)
+        if import_name:
+            return typename.replace(name, '{}.{}'.format(import_name, name))
             
-        return typename
+        return self.get_foreign_type(typename, spelling)
         
         
     def on_class_end(self, name):
@@ -528,8 +2442,8 @@ class PxdProxyVisitor(BaseVisitor):
             self.file.line('{} {}', typename, name)        
         
     def on_method(self, name, return_type, parameters, access, method_type, cursor, *l, **kw):
-        parameters = [(split_namespace_name(t)[0], n) for (t, n) in parameters]
-        parameters_list = ', '.join('{} {}'.format(self.get_use_type(t), n) for (t, n) in parameters)
+        parameters_list = ', '.join('{} {}'.format(self.get_use_type(split_namespace_name(t)[0], t), n)
+                                    for (t, n) in parameters)
         return_name, namespaces = split_namespace_name(return_type)
         
         self.file.line('{} {}({}) except +', return_name, name, parameters_list)
@@ -542,28 +2456,30 @@ class PxdProxyVisitor(BaseVisitor):
         pass
         
         
-class PyxVisitor(BaseVisitor):
+class PyxVisitor(ModuleVisitor):
     '''Generate pyx file wrappering C++ entieis in cython
     '''
     
-    def __init__(self, name, directory='.', time=None):
-        super(PyxVisitor, self).__init__(name, directory, time)
+    def __init__(self, name, directory='.', time=None, outputs=None):
+        super(PyxVisitor, self).__init__(name, directory, time, outputs)
         self.types = {}
         self.pod_types = set()
         self.class_types = set()
         self.constructors = set()
         
-    def on_file_begin(self, filename):
+    def begin_module(self, headers):
         # TODO Add file header
-        self.file = IndentFile(os.path.join(self.directory, self.name+'.pyx'))
-        self.import_name = os.path.splitext(os.path.basename(filename))[0]
+        self.file = self.open_file(os.path.join(self.directory, self.name+'.pyx'))
         self.import_proxy_name = self.name + '_cppython'
         
         self.file.line('# distutils: language = c++')
         # make python3 string convert to const char* automatically on interface
         # self.file.line('# cython: c_string_type=str, c_string_encoding=ascii')
         self.file.line("'''{}'''", self.banner)
-        self.file.line('cimport {}', self.import_name)
+        for header in headers:
+            self.file.line('cimport {}', os.path.splitext(os.path.basename(header))[0])
+        # used by pxi
+        self.cimport_foreign_types()
         self.file.line('cimport {}', self.import_proxy_name)
         self.file.line('cimport libc.string')
         self.file.line('from libcpp cimport bool')
@@ -580,7 +2496,7 @@ class PyxVisitor(BaseVisitor):
         self.file.line('import enum # for python 2.x install enum34 package')
         self.file.line()
         
-    def on_file_end(self):
+    def end_module(self):
         self.file.line('include "{}"', os.path.basename(self.file.name.replace('.pyx', '.pxi')))
         self.done()
         
@@ -636,6 +2552,13 @@ class PyxVisitor(BaseVisitor):
             
     def on_constructor(self, name, parameters):
         self.constructors.add(name)
+        foreign = self.get_foreign_names(t for (t, n) in parameters)
+        if foreign:
+            # the instance could not be created by any other constructor either
+            self.file.line('def __init__(self, *l, **kw):')
+            with indent(self.file):
+                self.file.line("raise TypeError('{} takes {} wrapped by another module')", name, ', '.join(foreign))
+            return
         proxy_name = get_proxy_name(name)        
         parameters = [(split_namespace_name(t)[0], n) for (t, n) in parameters]
         parameters_list = ', '.join('{} {}'.format(self.get_use_type(t), n) for (t, n) in parameters)
@@ -682,7 +2605,28 @@ class PyxVisitor(BaseVisitor):
                     self.file.line('self._this.{} = value', name)
         
                     
+    def get_foreign_names(self, types):
+        '''Return names of the types wrapped by another module
+
+        Their cdef classes are not declared in a pxd, so they could not be converted from python objects here.
+        '''
+        names = []
+        for t in types:
+            typename = split_namespace_name(t)[0]
+            foreign = self.get_foreign_type(typename, t)
+            if foreign != typename:
+                names.append(get_type_name(foreign))
+        return names
+
+    def skip_foreign(self, name, return_type, parameters):
+        foreign = self.get_foreign_names([return_type] + [t for (t, n) in parameters])
+        if foreign:
+            self.file.line('# {} is not wrapped, it uses {} wrapped by another module', name, ', '.join(foreign))
+        return bool(foreign)
+
     def on_method(self, name, return_type, parameters, access, method_type, cursor, *l, **kw):        
+        if self.skip_foreign(name, return_type, parameters):
+            return
         # remove namespace and reference
         parameters = [(split_namespace_name(t)[0], n) for (t, n) in parameters]
         parameters_list = 'self, ' + ', '.join('{} {}'.format(self.get_use_type(t), n) for (t, n) in parameters)
@@ -735,6 +2679,8 @@ class PyxVisitor(BaseVisitor):
         
         
     def on_function(self, name, return_type, parameters):
+        if self.skip_foreign(name, return_type, parameters):
+            return
         # remove namespace and reference
         parameters = [(split_namespace_name(t)[0], n) for (t, n) in parameters]
         parameters_list = ', '.join('{} {}'.format(self.get_use_type(t), n) for (t, n) in parameters)
@@ -754,29 +2700,29 @@ class PyxVisitor(BaseVisitor):
                 self.file.line('return ret')
 
                 
-class HppVisitor(BaseVisitor):
+class HppVisitor(ModuleVisitor):
     '''Generate C++ header file wrapping C++ non pod classes for use in python
     '''
     
-    def __init__(self, name, directory='.', time=None):
-        super(HppVisitor, self).__init__(name, directory, time)
+    def __init__(self, name, directory='.', time=None, outputs=None):
+        super(HppVisitor, self).__init__(name, directory, time, outputs)
         self.namespaces = []
         self.class_name = None
         self.constructors = set()
         
-    def on_file_begin(self, filename):
+    def begin_module(self, headers):
         # TODO Add file header
         
-        self.file = IndentFile(os.path.join(self.directory, self.name + '_cppython.hpp'))
-        self.header_file_path = os.path.relpath(filename, self.directory)
+        self.file = self.open_file(os.path.join(self.directory, self.name + '_cppython.hpp'))
         
-        stem = os.path.splitext(os.path.basename(filename))[0]
+        stem = os.path.splitext(os.path.basename(headers[0]))[0]
         self.header_guard = '_{}_CPPYTON_HPP_'.format(stem.upper())
         self.file.line("// {}", self.banner)
         self.file.line('#ifndef {}', self.header_guard)
         self.file.line('#define {}', self.header_guard)
         self.file.line()                
-        self.file.line('#include "{}"', self.header_file_path)
+        for header in headers:
+            self.file.line('#include "{}"', os.path.relpath(header, self.directory))
         self.file.line()        
         self.file.write('''
         
@@ -806,7 +2752,7 @@ private:
 
 ''')
         
-    def on_file_end(self):
+    def end_module(self):
         self.file.line('')
         self.file.line('#endif//{}', self.header_guard)
         self.done()
@@ -893,22 +2839,21 @@ private:
         pass
                 
                 
-class CppVisitor(BaseVisitor):
+class CppVisitor(ModuleVisitor):
     '''Generate C++ source files wrapping C++ non pod classes for use in python
     '''
     
-    def __init__(self, name, directory='.', time=None):
-        super(CppVisitor, self).__init__(name, directory, time)
+    def __init__(self, name, directory='.', time=None, outputs=None):
+        super(CppVisitor, self).__init__(name, directory, time, outputs)
         self.namespaces = []
         self.class_name = None
         
-    def on_file_begin(self, filename):
+    def begin_module(self, headers):
         # TODO Add file header
         
-        self.file = IndentFile(os.path.join(self.directory, self.name+'_cppython.cpp'))
+        self.file = self.open_file(os.path.join(self.directory, self.name+'_cppython.cpp'))
         self.header_file_path = self.name+'_cppython.hpp'
         
-        stem = os.path.basename(os.path.splitext(filename)[0])
         self.file.line("// {}", self.banner)
         self.file.line('#include "{}"', self.header_file_path)
         self.file.write('''
@@ -930,9 +2875,6 @@ CppythonProxyBase::~CppythonProxyBase()
 
 ''' % self.name)
         
-    def on_file_end(self):
-        self.done()
-        
     def on_namespace_begin(self, namespace):
         self.namespaces.append(namespace)
         
@@ -1007,22 +2949,21 @@ CppythonProxyBase::~CppythonProxyBase()
          
         
         
-class PxiVisitor(BaseVisitor):
+class PxiVisitor(ModuleVisitor):
     '''Generate public API for wrapping C++
     '''
     
-    def __init__(self, name, directory='.', time=None):
-        super(PxiVisitor, self).__init__(name, directory, time)
+    def __init__(self, name, directory='.', time=None, outputs=None):
+        super(PxiVisitor, self).__init__(name, directory, time, outputs)
         self.namespaces = []
         self.class_name = None
-        self.pod_types = set()
-        self.class_types = set()
+        # name -> import name of the header defining it
+        self.pod_types = {}
+        self.class_types = {}
         
-    def on_file_begin(self, filename):
+    def begin_module(self, headers):
         # TODO Add file header
-        self.import_name = os.path.basename(os.path.splitext(filename)[0])
-        
-        self.file = IndentFile(os.path.join(self.directory, self.name+'.pxi'))
+        self.file = self.open_file(os.path.join(self.directory, self.name+'.pxi'))
 
         self.file.line("'''{}'''", self.banner)        
         self.file.line('import types')
@@ -1033,9 +2974,6 @@ class PxiVisitor(BaseVisitor):
             self.file.line('method = getattr(self, method_name.decode("utf-8"), None)')
             self.file.line('return isinstance(method, types.MethodType)')
         
-    def on_file_end(self):
-        self.done()
-        
     def on_namespace_begin(self, namespace):
         self.namespaces.append(namespace)
         
@@ -1055,14 +2993,14 @@ class PxiVisitor(BaseVisitor):
         pass
         
     def on_pod_begin(self, kind, name, typedef):
-        self.pod_types.add(name)
+        self.pod_types[name] = self.import_name
         
     def on_pod_end(self, name):
         pass
         
     def on_class_begin(self, kind, name, typedef):
         self.class_name = name
-        self.class_types.add(name)
+        self.class_types[name] = self.import_name
         
     def on_class_end(self, name):
         self.class_name = None
@@ -1077,23 +3015,25 @@ class PxiVisitor(BaseVisitor):
             return '{}()._from_c_({}{})'.format(typename, name, '[0]' if is_pointer else '')
         return name
         
-    def get_use_type(self, typename):
+    def get_use_type(self, typename, spelling=None):
         unquanlified_type, quanlify, pointer = parse_type(typename)
-        if unquanlified_type in self.pod_types or unquanlified_type in self.class_types:
-            return '{}.{}{}'.format(self.import_name, unquanlified_type, pointer)
-        return typename
+        import_name = self.pod_types.get(unquanlified_type) or self.class_types.get(unquanlified_type)
+        if import_name:
+            return '{}.{}{}'.format(import_name, unquanlified_type, pointer)
+        return self.get_foreign_type(typename, spelling)
         
     def on_method(self, name, return_type, parameters, access, method_type, cursor, *l, **kw):        
         if method_type not in ('virtual', 'pure'):
             return
             
+        parameters_list = ', '.join('{} {}'.format(self.get_use_type(split_namespace_name(t)[0], t), n)
+                                    for (t, n) in parameters)
         parameters = [(split_namespace_name(t)[0], n) for (t, n) in parameters]
-        parameters_list = ', '.join('{} {}'.format(self.get_use_type(t), n) for (t, n) in parameters)
         parameters_names = [(n, self.get_use_format(t, n)) for (t, n) in parameters]
         # make it keyword parameter
         parameters_names = ', '.join('{}={}'.format(name[0], name[1]) for name in parameters_names)
         return_name, namespaces = split_namespace_name(return_type)
-        return_name = self.get_use_type(return_name)
+        return_name = self.get_use_type(return_name, return_type)
         
         parameters_list = ', '.join(['object self', parameters_list])
         self.file.line('cdef public {} {}_{}_proxy_call({}) with gil:',
@@ -1112,20 +3052,127 @@ class PxiVisitor(BaseVisitor):
         pass
         
         
+VISITORS = (PxdVisitor, PyxVisitor, CppVisitor, HppVisitor, PxiVisitor, PxdProxyVisitor)
+
+
+def write_outputs(outputs, changed_only=True):
+    '''Write generated files, skip the ones whose content does not change if changed_only
+
+    Return paths of the written files.
+    '''
+    written = []
+    for path in sorted(outputs):
+        content = outputs[path]
+        if changed_only:
+            try:
+                with open(path, 'rb') as f:
+                    if f.read() == content:
+                        continue
+            except (IOError, OSError):
+                pass
+        with open(path, 'wb') as f:
+            f.write(content)
+        written.append(path)
+    return written
+
+
+class Watcher(object):
+    '''Keep translation units of headers alive and regenerate module once they change
+
+    Changed translation unit is reparsed incrementally, session parses with
+    a precompiled preamble of the included files for that. Module is only
+    regenerated if the events of any header change, and only generated files
+    with different content are written, so that unchanged files do not
+    trigger rebuild.
+    '''
+    def __init__(self, headers, module_name, directory, session, cursor_filter=None):
+        self.headers = headers
+        self.module_name = module_name
+        self.directory = directory
+        self.session = session
+        # so that reparse only parses the header itself again
+        session.preamble = True
+        self.cursor_filter = cursor_filter
+        # fixed banner time, otherwise every generated file differs
+        self.time = datetime.now()
+        self.macros = cursor_filter is None or cursor_filter.wants_macros()
+        self.filters = [cursor_filter and cursor_filter.for_header(h, headers) for h in headers]
+        self.units = [session.parse(h, macros=self.macros) for h in headers]
+        self.events = [record_events(tu, f) for tu, f in zip(self.units, self.filters)]
+        self.mtimes = [get_mtimes(session.get_dependencies(tu)) for tu in self.units]
+
+    def generate(self):
+        outputs = {}
+        visitors = VisitorGroup(v(self.module_name, self.directory, self.time, outputs) for v in VISITORS)
+        visitors.on_module_begin(self.headers)
+        for events in self.events:
+            replay(events, visitors)
+        visitors.on_module_end()
+        return write_outputs(outputs)
+
+    def poll(self):
+        '''Reparse changed headers, return paths of the regenerated files
+        '''
+        changed = False
+        for i, header in enumerate(self.headers):
+            tu = self.units[i]
+            mtimes = get_mtimes(self.session.get_dependencies(tu))
+            if mtimes == self.mtimes[i]:
+                continue
+
+            pch_files = self.session.pch_dependencies.get(header, [])
+            if any(mtimes.get(f) != self.mtimes[i].get(f) for f in pch_files):
+                # pch is outdated, parse from scratch to rebuild it
+                tu.dispose()
+                tu = self.units[i] = self.session.parse(header, macros=self.macros)
+            else:
+                self.session.reparse(tu)
+            self.mtimes[i] = get_mtimes(self.session.get_dependencies(tu))
+
+            events = record_events(tu, self.filters[i])
+            if events != self.events[i]:
+                self.events[i] = events
+                changed = True
+
+        if not changed:
+            return []
+        return self.generate()
+
+    def run(self, interval=1.0):
+        while True:
+            time.sleep(interval)
+            for path in self.poll():
+                print('regenerating {} ...'.format(path))
+
+
 def generate_setup_file(
         name, directory='.', sources=[], 
         include=[], library=[], library_dir=[], compile_flag=[], 
-        link_flag=[], objects=[], time=None):
+        link_flag=[], objects=[], time=None, cython_include=[]):
     '''Generate setup file for building python extension
     '''
+    content = get_setup_file_content(
+        name, directory, sources, include, library, library_dir,
+        compile_flag, link_flag, objects, time, cython_include)
+    with open(os.path.join(directory, 'setup.py'), 'w') as f:
+        f.write(content)
+
+
+def get_setup_file_content(
+        name, directory='.', sources=[], 
+        include=[], library=[], library_dir=[], compile_flag=[], 
+        link_flag=[], objects=[], time=None, cython_include=[]):
+    '''Return content of setup file for building python extension
+
+    cython_include are the directories of the pxd files cimported from other modules.
+    '''
     if time is None:
         time = datetime.now()
     
     banner = 'Generated by cppython v{} at {} for {} module'.format(__version__, time.isoformat(), name) 
     sources = [os.path.relpath(os.path.abspath(i), directory) for i in sources]
     
-    with open(os.path.join(directory, 'setup.py'), 'w') as f:
-        f.write('''#! /usr/bin/env python
+    return '''#! /usr/bin/env python
 # -*- coding: utf-8 -*-
 '{}'
 import sys
@@ -1156,19 +3203,200 @@ if __name__ == '__main__':
         sys.argv.append('build_ext')
         sys.argv.append('--inplace')
     
-    setup(ext_modules=cythonize(extensions))
+    setup(ext_modules=cythonize(extensions, include_path={}))
         '''.format( 
             banner, name, name, name, ', '.join("'{}'".format(i) for i in sources),
-            objects, include, library, library_dir, compile_flag, link_flag))
+            objects, include, library, library_dir, compile_flag, link_flag, cython_include)
 
-        
-        
-def main(argv):
-    cmd_parser = argparse.ArgumentParser()
+
+def generate(headers, module, directory='.', sources=[],
+             include=[], library=[], library_dir=[], compile_flag=[],
+             link_flag=[], objects=[], cursor_filter=None, session=None,
+             cache=None, jobs=1, time=None, symbols=None, umbrella=False):
+    '''Generate python extension module wrapping C++ headers
+
+    Return generated files including setup.py as a dict of path -> content in
+    bytes, path is in directory. Nothing is written, it is up to the caller.
+    Only entities declared in headers are wrapped unless cursor_filter says
+    otherwise.
+
+    If symbols is a SymbolIndex, classes and structs wrapped by other modules
+    are cimported from their pxd, whose directories are added to the include
+    paths of setup.py, and the entities of this module are added to it.
+
+    If umbrella is true, headers are parsed together as one translation unit
+    by parse_umbrella() instead of one by one in jobs processes.
+    '''
+    if time is None:
+        time = datetime.now()
+    if cursor_filter is None:
+        cursor_filter = CursorFilter(headers, 'main')
+
+    outputs = {}
+    group = VisitorGroup((v(module, directory, time, outputs) for v in VISITORS), _profiler)
+    if umbrella and len(headers) > 1:
+        events_list = parse_umbrella(headers, cache, session, cursor_filter)
+    else:
+        events_list = parse_headers(headers, cache, jobs, session, cursor_filter)
+    foreign_types = {}
+    if symbols is not None:
+        with profile_phase('symbol index'):
+            foreign_types = get_foreign_types(events_list, symbols)
+            group.on_foreign_types(foreign_types)
+    group.on_module_begin(headers)
+    for events in events_list:
+        # replay cached events does not need libclang at all
+        replay(events, group)
+    group.on_module_end()
+    if symbols is not None:
+        with profile_phase('symbol index'):
+            symbols.update(module, directory, [i for events in events_list for i in get_symbols(events)])
+
+    # pxd of other modules and the headers they refer to relatively are found from their directory
+    foreign_directories = sorted(set(i[2] for i in foreign_types.values()) - set([os.path.abspath(directory)]))
+    with profile_phase('generate_setup_file'):
+        setup_file = get_setup_file_content(
+            module, directory, sources, list(include) + foreign_directories, library, library_dir,
+            compile_flag, link_flag, objects, time, foreign_directories)
+    outputs[os.path.join(directory, 'setup.py')] = setup_file.encode('utf-8')
+    return outputs
+
+
+# manifest keys whose paths are relative to the manifest
+MANIFEST_PATHS = ('module', 'header', 'source', 'include', 'library_dir', 'object', 'allow')
+# options of a module in manifest by type, the ones get_generate_arguments() uses
+MANIFEST_LISTS = ('header', 'source', 'include', 'library', 'library_dir', 'compile_flag', 'link_flag',
+                  'object', 'allow', 'only_namespace', 'include_entity', 'exclude_entity')
+MANIFEST_STRINGS = ('module', 'macros', 'macro_regex')
+MANIFEST_FLAGS = ('umbrella',)
+
+
+def check_manifest_value(key, value, path):
+    '''Return value of option key of a module in manifest path, raise ValueError if it has a wrong type
+
+    A string is taken as a list of one string for options taking a list.
+    '''
+    strings = (str, unicode)
+    if key in MANIFEST_LISTS:
+        if isinstance(value, strings):
+            value = [value]
+        if not isinstance(value, list) or not all(isinstance(i, strings) for i in value):
+            raise ValueError('option {} of module in {} must be a list of strings, not {}'.format(
+                key, path, json.dumps(value)))
+    elif key in MANIFEST_FLAGS:
+        if not isinstance(value, bool):
+            raise ValueError('option {} of module in {} must be true or false, not {}'.format(
+                key, path, json.dumps(value)))
+    elif key in MANIFEST_STRINGS:
+        if not isinstance(value, strings):
+            raise ValueError('option {} of module in {} must be a string, not {}'.format(
+                key, path, json.dumps(value)))
+    else:
+        raise ValueError('option {} is not allowed for module in {}'.format(key, path))
+    return value
+
+
+def load_manifest(path, defaults):
+    '''Return settings of each module listed in manifest file
+
+    Manifest is a json list of modules. Each module is an object whose keys are
+    the long command line options, like {"module": "out/foo", "header": ["foo.hpp"]},
+    missing ones are taken from defaults. Relative paths are relative to the manifest.
+    Options taking a list also take a single string. Only the options of
+    generating a module are allowed, not the ones of the whole run like
+    --jobs or --pch.
+    '''
+    with open(path, 'rb') as f:
+        entries = json.loads(u(f.read()))
+    base = os.path.dirname(os.path.abspath(path))
+    modules = []
+    if not isinstance(entries, list) or not all(isinstance(i, dict) for i in entries):
+        raise ValueError('manifest {} is not a list of modules'.format(path))
+    for entry in entries:
+        settings = argparse.Namespace(**vars(defaults))
+        for key, value in entry.items():
+            key = key.replace('-', '_')
+            value = check_manifest_value(key, value, path)
+            if key in MANIFEST_PATHS:
+                if isinstance(value, list):
+                    value = [os.path.join(base, i) for i in value]
+                else:
+                    value = os.path.join(base, value)
+            setattr(settings, key, value)
+        if not settings.module or not settings.header:
+            raise ValueError('module without module or header in {}'.format(path))
+        modules.append(settings)
+    return modules
+
+
+def get_generate_arguments(settings):
+    '''Return keyword arguments of generate() from settings of command line or manifest
+    '''
+    headers = list(settings.header)
+    return dict(
+        headers=headers,
+        module=os.path.basename(settings.module),
+        directory=os.path.dirname(settings.module),
+        sources=settings.source,
+        include=[os.path.abspath(i) for i in settings.include],
+        library=settings.library,
+        library_dir=[os.path.abspath(i) for i in settings.library_dir],
+        compile_flag=[i.strip() for i in settings.compile_flag],
+        link_flag=[i.strip() for i in settings.link_flag],
+        objects=settings.object,
+        umbrella=settings.umbrella,
+        cursor_filter=CursorFilter(
+            headers + settings.allow, settings.macros, settings.macro_regex,
+            settings.only_namespace, settings.include_entity, settings.exclude_entity),
+    )
+
+
+def generate_module(arguments):
+    '''Generate one module of a batch, return (module path, generated files, seconds)
+    '''
+    start = time.time()
+    outputs = generate(jobs=1, **arguments)
+    return os.path.join(arguments['directory'], arguments['module']), outputs, time.time() - start
+
+
+def generate_modules(modules, session=None, cache=None, jobs=None, symbols=None):
+    '''Generate modules in a process pool, yield what generate_module() returns in the same order as modules
+
+    modules are keyword arguments of generate(). Each worker loads libclang
+    once and parses with the same session for all the modules it generates,
+    files they include are shared through cache and pch. Module only finds
+    the types of the modules before it in symbols if jobs is 1.
+    '''
+    import multiprocessing
+
+    if session is None:
+        session = get_default_session()
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(modules))
+    if jobs <= 1:
+        for arguments in modules:
+            yield generate_module(dict(arguments, session=session, cache=cache, symbols=symbols))
+        return
+
+    pool = multiprocessing.Pool(jobs, set_default_session, (session,))
+    try:
+        for result in pool.imap(generate_module, [dict(i, cache=cache, symbols=symbols) for i in modules]):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_cmd_parser():
+    cmd_parser = argparse.ArgumentParser(
+        epilog='run "%(prog)s serve -h" for the resident generator command line clients are forwarded to')
     
     cmd_parser.add_argument('-v', '--version', action='version', version='%(prog)s {}'.format(__version__))
-    cmd_parser.add_argument('-t', '--header', metavar='cpp_header_file.hpp', nargs=1, required=True,
-                            help='target c++ header file for wrapping to python module')
+    cmd_parser.add_argument('-t', '--header', metavar='cpp_header_file.hpp', nargs='+',
+                            help='target c++ header files for wrapping to python module, - reads one from stdin')
+    cmd_parser.add_argument('--stdin-name', metavar='path/to/header.hpp', default='stdin.hpp',
+                            help='path the header read from stdin is parsed and included as, default to stdin.hpp')
     cmd_parser.add_argument('-s', '--source', metavar='cpp_source_file.cpp', nargs='*', default=[],
                             help='additional c++ source files')
     cmd_parser.add_argument('-i', '--include', metavar='dir/to/c++/include', nargs='*', default=[],
@@ -1177,41 +3405,385 @@ def main(argv):
                             help='additional library to link')
     cmd_parser.add_argument('-d', '--library-dir', metavar='path/to/lib', nargs='*', default=[],
                             help='additional library directory')
-    cmd_parser.add_argument('-m', '--module', metavar='module_dir/module', required=True,
+    cmd_parser.add_argument('-m', '--module', metavar='module_dir/module',
                             help='target module output path and module name')
+    cmd_parser.add_argument('--manifest', metavar='modules.json',
+                            help='generate every module listed in this json file in a process pool instead of -t and -m, '
+                            'each module is an object of long options like {"module": "out/foo", "header": ["foo.hpp"]}, '
+                            'a single string may be given for options taking a list')
     cmd_parser.add_argument('-c', '--compile-flag', metavar='" -O3"', nargs="*", default=[],
                             help='specify extra compile flag, with extra space before -, like this: " -O3"')
     cmd_parser.add_argument('-k', '--link-flag', metavar='" -O3"', nargs="*", default=[],
                             help='specify extra link flag, with extra space before -, like this: " -O3"')
     cmd_parser.add_argument('-o', '--object', metavar='path/to/a.so"', nargs="*", default=[],
                             help='specify extra objects to link against')
-    
+    cmd_parser.add_argument('-a', '--allow', metavar='path/to/header/or/dir', nargs='*', default=[],
+                            help='also wrap entities declared in these files or directories besides target headers')
+    cmd_parser.add_argument('--macros', choices=CursorFilter.MACRO_MODES, default='main',
+                            help='export no macro, macros defined in target headers or all the allowed ones, default to main')
+    cmd_parser.add_argument('--macro-regex', metavar='REGEX',
+                            help='only export macros whose name matches this regular expression')
+    cmd_parser.add_argument('--only-namespace', metavar='foo::bar', nargs='*', default=[],
+                            help='only wrap entities inside these namespaces')
+    cmd_parser.add_argument('--include-entity', metavar='REGEX', nargs='*', default=[],
+                            help='only wrap namespace level entities whose whole qualified name like foo::Bar matches any of these')
+    cmd_parser.add_argument('--exclude-entity', metavar='REGEX', nargs='*', default=[],
+                            help='do not wrap entities or class members whose whole qualified name matches any of these')
+    cmd_parser.add_argument('--cache-dir', metavar='path/to/cache',
+                            help='cache parsed header in this directory, reuse it while header is not changed')
+    cmd_parser.add_argument('--cache-size', metavar='MB', type=int, default=256,
+                            help='max size of the cache directory in MB, least recently used entries are evicted')
+    cmd_parser.add_argument('--pch', action='store_true',
+                            help='precompile files included by header, stored in cache directory or module directory')
+    cmd_parser.add_argument('--umbrella', action='store_true',
+                            help='parse all headers as one translation unit including them, so that files they '
+                            'share are parsed once. File included by several headers is wrapped by the first one')
+    cmd_parser.add_argument('--symbol-index', metavar='symbols.sqlite',
+                            help='record wrapped classes and structs in this sqlite file, cimport the ones wrapped by '
+                            'modules generated before instead of treating them as unknown types')
+    cmd_parser.add_argument('--stub-std', action='store_true',
+                            help='parse with stub C++ standard headers declaring just the names used in declarations, '
+                            'header that does not compile with them is parsed again with the real ones')
+    cmd_parser.add_argument('--max-memory', metavar='MB', type=int, default=None,
+                            help='stop once parsing a header takes more than this memory in each process')
+    cmd_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                            help='parse headers, or generate modules of manifest, in N processes, default to the number of cores')
+    cmd_parser.add_argument('--profile', metavar='profile.json', nargs='?', const='',
+                            help='report time and memory of each generation phase, also saved as json, '
+                            'default to module_profile.json beside the module. Headers are parsed in this process')
+    cmd_parser.add_argument('--profile-stats', metavar='profile.pstats',
+                            help='also save cProfile statistics of the whole generation, implies --profile')
+    cmd_parser.add_argument('-w', '--watch', action='store_true',
+                            help='keep running, regenerate module once header or any file it includes changes')
+    cmd_parser.add_argument('--watch-interval', metavar='SECONDS', type=float, default=1.0,
+                            help='interval of checking changed files in watch mode')
+    cmd_parser.add_argument('--server-socket', metavar='path/to/socket',
+                            help='socket of the resident generator, default to $CPPYTHON_SOCKET or ~/.cppython.sock')
+    cmd_parser.add_argument('--server-timeout', metavar='SECONDS', type=float, default=120.0,
+                            help='generate in process if the resident generator does not answer in time, default to 120')
+    cmd_parser.add_argument('--no-server', action='store_true',
+                            help='always generate in this process even if a resident generator is running')
+    return cmd_parser
+
+
+def check_args(cmd_parser, args):
+    if args.manifest is None and not (args.header and args.module):
+        cmd_parser.error('-t/--header and -m/--module are required without --manifest')
+    if args.manifest is not None and args.watch:
+        cmd_parser.error('--watch does not work with --manifest')
+
+
+def get_modules(args):
+    '''Return keyword arguments of generate() for each module of command line
+    '''
+    if args.manifest is not None:
+        return [get_generate_arguments(i) for i in load_manifest(args.manifest, args)]
+    return [get_generate_arguments(args)]
+
+
+def configure_session(session, args):
+    '''Apply the parse options of command line to session
+    '''
+    session.max_memory = args.max_memory*1024*1024 if args.max_memory else None
+    session.stubs = args.stub_std
+    session.pch_directory = None
+    if args.pch:
+        directory = os.path.dirname(args.manifest if args.manifest is not None else args.module)
+        session.pch_directory = args.cache_dir or os.path.join(directory, '.cppython_pch')
+
+
+def get_cache(args):
+    if args.cache_dir:
+        return HeaderCache(args.cache_dir, args.cache_size*1024*1024)
+    return None
+
+
+def get_symbol_index(args):
+    if args.symbol_index:
+        return SymbolIndex(args.symbol_index)
+    return None
+
+
+def get_server_socket():
+    '''Return path of the socket the resident generator listens on by default
+    '''
+    return os.environ.get('CPPYTHON_SOCKET') or os.path.join(os.path.expanduser('~'), '.cppython.sock')
+
+
+# seconds to wait for a resident generator answering a ping
+PING_TIMEOUT = 5.0
+# seconds a client connected to the resident generator may stay silent before it is dropped
+IDLE_TIMEOUT = 10.0
+
+def request_server(path, request, timeout=None):
+    '''Send request to the resident generator listening on path and return its response
+
+    Return None if no generator is running, or if it does not answer within
+    timeout seconds, so that the caller can do the work itself.
+    '''
+    if not os.path.exists(path):
+        return None
+    # not needed unless a generator is running
+    import socket
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        try:
+            connection.connect(path)
+            stream = connection.makefile('rwb')
+            stream.write(json.dumps(request).encode('utf-8') + b'\n')
+            stream.flush()
+            line = stream.readline()
+            stream.close()
+        except (socket.error, socket.timeout):
+            return None
+    finally:
+        connection.close()
+    if not line:
+        return None
+    return json.loads(u(line))
+
+
+class Server(object):
+    '''Resident generator answering requests of command line clients
+
+    libclang stays loaded and translation units of the parsed headers are kept
+    by a ResidentSession, so that a request only reparses what has changed.
+
+    Each request is a line of json {"version": ..., "cwd": ..., "argv": [...]} with
+    the command line arguments of the client, it is answered by a line of json
+    {"version": ..., "outputs": {path: content}, "modules": [[module, seconds], ...]}
+    or {"version": ..., "error": message}. Request {"ping": true} is answered by
+    {"version": ...} and {"stop": true} stops the server.
+    '''
+    def __init__(self, session=None):
+        self.session = session or ResidentSession()
+        self.cmd_parser = get_cmd_parser()
+        self.running = True
+
+    def handle(self, request):
+        if request.get('ping'):
+            return {'version': __version__}
+        if request.get('stop'):
+            self.running = False
+            return {'version': __version__, 'stopped': True}
+        if request.get('version') != __version__:
+            return {'version': __version__, 'error': 'cppython v{} is required'.format(request.get('version'))}
+
+        directory = os.getcwd()
+        try:
+            os.chdir(request['cwd'])
+            args = self.cmd_parser.parse_args(request['argv'])
+            check_args(self.cmd_parser, args)
+            configure_session(self.session, args)
+            cache = get_cache(args)
+            symbols = get_symbol_index(args)
+            outputs = {}
+            modules = []
+            for arguments in get_modules(args):
+                module, module_outputs, seconds = generate_module(
+                    dict(arguments, session=self.session, cache=cache, symbols=symbols))
+                outputs.update(module_outputs)
+                modules.append([module, seconds])
+        except SystemExit:
+            # argparse has reported the error already
+            return {'version': __version__, 'error': 'invalid arguments: {}'.format(' '.join(request['argv']))}
+        except Exception as e:
+            return {'version': __version__, 'error': '{}: {}'.format(type(e).__name__, e)}
+        finally:
+            os.chdir(directory)
+
+        return {
+            'version': __version__,
+            'outputs': dict((path, u(content)) for (path, content) in outputs.items()),
+            'modules': modules,
+        }
+
+    def serve_stream(self, input, output):
+        '''Answer requests read from input line by line until it ends or server is stopped
+        '''
+        while self.running:
+            line = input.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(u(line))
+            except ValueError as e:
+                response = {'version': __version__, 'error': 'invalid request: {}'.format(e)}
+            else:
+                response = self.handle(request)
+            output.write(json.dumps(response).encode('utf-8') + b'\n')
+            output.flush()
+
+    def serve_socket(self, path):
+        '''Answer requests of clients connecting to unix socket path, one at a time
+
+        Client silent for IDLE_TIMEOUT seconds is dropped, so that it does not
+        block the others.
+        '''
+        import socket
+        import stat
+
+        if request_server(path, {'version': __version__, 'ping': True}, PING_TIMEOUT) is not None:
+            raise RuntimeError('another server is listening on {}'.format(path))
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise RuntimeError('{} exists and is not a socket'.format(path))
+            # left by a server that did not stop cleanly
+            os.remove(path)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            listener.listen(5)
+            while self.running:
+                connection, address = listener.accept()
+                connection.settimeout(IDLE_TIMEOUT)
+                try:
+                    stream = connection.makefile('rwb')
+                    self.serve_stream(stream, stream)
+                    stream.close()
+                except socket.error:
+                    # timed out or gone, socket.timeout is a socket.error
+                    pass
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+            os.remove(path)
+
+
+def serve(argv):
+    cmd_parser = argparse.ArgumentParser(
+        prog='cppython.py serve',
+        description='keep libclang and parsed headers in memory, generate modules for command line clients')
+    cmd_parser.add_argument('--socket', metavar='path/to/socket', default=None,
+                            help='unix socket to listen on, default to $CPPYTHON_SOCKET or ~/.cppython.sock')
+    cmd_parser.add_argument('--stdio', action='store_true',
+                            help='answer requests read from stdin on stdout instead of listening on socket')
+    cmd_parser.add_argument('--max-units', metavar='N', type=int, default=32,
+                            help='keep at most N parsed headers in memory, default to 32')
+    args = cmd_parser.parse_args(argv)
+
+    server = Server(ResidentSession(max_units=args.max_units))
+    try:
+        if args.stdio:
+            server.serve_stream(getattr(sys.stdin, 'buffer', sys.stdin), getattr(sys.stdout, 'buffer', sys.stdout))
+        else:
+            path = args.socket or get_server_socket()
+            print('serving on {}, press Ctrl-C to stop'.format(path))
+            server.serve_socket(path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.session.clear()
+    print('done.', file=sys.stderr if args.stdio else sys.stdout)
+
+
+def main(argv):
+    if sys.argv[1:2] == ['serve']:
+        return serve(sys.argv[2:])
+
+    cmd_parser = get_cmd_parser()
     args = cmd_parser.parse_args(sys.argv[1:])
-    
-    module_name = os.path.basename(args.module)
-    directory = os.path.dirname(args.module)
-    if directory and not os.path.exists(directory):
-        os.makedirs(directory)
-    
-    header = args.header
-    cpp_files = args.source
-    include = [os.path.abspath(i) for i in args.include]
-    library_dir = [os.path.abspath(i) for i in args.library_dir]
-    compile_flag = [i.strip() for i in args.compile_flag]
-    link_flag = [i.strip() for i in args.link_flag]
-    
-    visitors = [v(module_name, directory) for v in
-                (PxdVisitor, PyxVisitor, CppVisitor, HppVisitor, PxiVisitor, PxdProxyVisitor)]
-    
-    apply([parse_cpp_file(h).cursor for h in header], VisitorGroup(visitors))
-        
-    for v in visitors:
-        print('generating {} ...'.format(v.file.name))
-        
-    print('generating setup.py ...')
-    generate_setup_file(
-        module_name, directory, cpp_files, include, args.library, 
-        library_dir, compile_flag, link_flag, args.object)
+    check_args(cmd_parser, args)
+
+    if (not args.no_server and not args.watch and args.profile is None and not args.profile_stats
+        and '-' not in (args.header or [])):
+        response = request_server(
+            args.server_socket or get_server_socket(),
+            {'version': __version__, 'cwd': os.getcwd(), 'argv': sys.argv[1:]}, args.server_timeout)
+        # a generator of other version could not be used
+        if response is not None and response.get('version') == __version__:
+            if 'error' in response:
+                sys.exit('ERROR: {}'.format(response['error']))
+            outputs = dict((path, content.encode('utf-8')) for (path, content) in response['outputs'].items())
+            for path in outputs:
+                if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+            written = write_outputs(outputs, changed_only=False)
+            if args.manifest is None:
+                for path in written:
+                    print('generating {} ...'.format(path))
+            else:
+                for module, seconds in response['modules']:
+                    print('generated {} in {:.2f} s'.format(module, seconds))
+            print('done.')
+            return
+
+    session = Session()
+    if args.manifest is None and '-' in args.header:
+        # parsed from memory, only the generated code includes it from stdin_name
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        session.add_unsaved_file(args.stdin_name, stdin.read())
+        args.header[args.header.index('-')] = args.stdin_name
+    modules = get_modules(args)
+    directory = os.path.dirname(args.manifest) if args.manifest is not None else modules[0]['directory']
+
+    for module in modules:
+        if module['directory'] and not os.path.exists(module['directory']):
+            os.makedirs(module['directory'])
+    configure_session(session, args)
+
+    if args.watch:
+        module = modules[0]
+        watcher = Watcher(module['headers'], module['module'], module['directory'], session, module['cursor_filter'])
+        for path in watcher.generate():
+            print('generating {} ...'.format(path))
+        print('generating setup.py ...')
+        generate_setup_file(
+            module['module'], module['directory'], module['sources'], module['include'], module['library'],
+            module['library_dir'], module['compile_flag'], module['link_flag'], module['objects'])
+        print('watching for changes, press Ctrl-C to stop')
+        try:
+            watcher.run(args.watch_interval)
+        except KeyboardInterrupt:
+            print('done.')
+        return
+
+    profiler = stats = None
+    jobs = args.jobs
+    if args.profile is not None or args.profile_stats:
+        profiler = Profiler()
+        set_profiler(profiler)
+        # workers could not be profiled
+        jobs = 1
+        if args.profile_stats:
+            import cProfile
+            stats = cProfile.Profile()
+            stats.enable()
+
+    cache = get_cache(args)
+    symbols = get_symbol_index(args)
+    if args.manifest is None:
+        outputs = generate(session=session, cache=cache, jobs=jobs, symbols=symbols, **modules[0])
+        with profile_phase('write files'):
+            for path in write_outputs(outputs, changed_only=False):
+                print('generating {} ...'.format(path))
+    else:
+        start = time.time()
+        for module, outputs, seconds in generate_modules(modules, session, cache, jobs, symbols):
+            with profile_phase('write files'):
+                write_outputs(outputs, changed_only=False)
+            print('generated {} in {:.2f} s'.format(module, seconds))
+        print('generated {} modules in {:.2f} s'.format(len(modules), time.time() - start))
+
+    if profiler is not None:
+        set_profiler(None)
+        if stats is not None:
+            stats.disable()
+            stats.dump_stats(args.profile_stats)
+        if args.manifest is None:
+            profile_path = os.path.join(directory, modules[0]['module'] + '_profile.json')
+        else:
+            profile_path = os.path.splitext(args.manifest)[0] + '_profile.json'
+        profile_path = args.profile or profile_path
+        profiler.dump(profile_path)
+        profiler.report()
+        print('profile saved to {}'.format(profile_path))
 
     print('done.')
     
@@ -1219,7 +3791,13 @@ def main(argv):
 if __name__ == '__main__':
     try:
         main(sys.argv)
-    except LibclangError as e:
+    except MemoryLimitError as e:
+        print('ERROR: {}'.format(e))
+        sys.exit(1)
+    except Exception as e:
+        # do not load clang.cindex just to check the exception
+        if not isinstance(e, getattr(sys.modules.get('clang.cindex'), 'LibclangError', ())):
+            raise
         print('ERROR: clang shared library not found, please download and place it in this directory: {}'.format(
             os.path.dirname(clang.__file__)))
         
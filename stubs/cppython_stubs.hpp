@@ -0,0 +1,65 @@
+// Stub of the C++ standard library for cppython --stub-std
+//
+// Only the names used in declarations are declared, so that parsing a header
+// does not pay for the real library. Nothing here is ever compiled, the
+// generated code is built against the real headers.
+#pragma once
+#include <stdint.h>
+
+// same as stddef.h, which is not always found without the compiler headers
+typedef __SIZE_TYPE__ size_t;
+typedef __PTRDIFF_TYPE__ ptrdiff_t;
+
+namespace std {
+    using ::size_t;
+    using ::ptrdiff_t;
+    using ::int8_t;
+    using ::int16_t;
+    using ::int32_t;
+    using ::int64_t;
+    using ::uint8_t;
+    using ::uint16_t;
+    using ::uint32_t;
+    using ::uint64_t;
+    using ::intptr_t;
+    using ::uintptr_t;
+#if __cplusplus >= 201103L
+    typedef decltype(nullptr) nullptr_t;
+#endif
+
+    template <class T> class allocator {
+    public:
+        typedef T value_type;
+        allocator();
+        allocator(const allocator&);
+        ~allocator();
+    };
+
+    template <class T> struct less { bool operator()(const T&, const T&) const; };
+    template <class T> struct equal_to { bool operator()(const T&, const T&) const; };
+    template <class T> struct hash { size_t operator()(const T&) const; };
+    template <class C> struct char_traits { typedef C char_type; };
+
+    template <class T1, class T2> struct pair {
+        typedef T1 first_type;
+        typedef T2 second_type;
+        T1 first;
+        T2 second;
+        pair();
+        pair(const T1&, const T2&);
+    };
+    template <class T1, class T2> pair<T1, T2> make_pair(T1, T2);
+
+    // a container is never POD, whatever it contains
+    template <class T, class A> class container_stub {
+    public:
+        typedef T value_type;
+        typedef A allocator_type;
+        typedef std::size_t size_type;
+        container_stub();
+        container_stub(const container_stub&);
+        ~container_stub();
+        size_type size() const;
+        bool empty() const;
+    };
+}
@@ -6,7 +6,13 @@
 
 import sys
 import os
+import shutil
+import tempfile
+import pickle
+import time
+import argparse
 import unittest
+import cppython
 from cppython import *
 try:
     import unittest.mock as mock
@@ -28,6 +34,11 @@ class Test(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def make_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
     def test_apply_mock(self):
         mock = MagicMock()
         apply([self.tu.cursor], mock)
@@ -45,23 +56,28 @@ class Test(unittest.TestCase):
             call.on_macro_value('DEFINE_1', "'1'"),
             call.on_namespace_begin('for_test_namespace'),
             call.on_namespace_begin('inner_namespace'),
+            call.on_symbol(ANY, 'for_test_namespace::inner_namespace::IntType'),
             call.on_typedef('IntType', 'int'),
+            call.on_symbol(ANY, 'for_test_namespace::inner_namespace::EnumType'),
             call.on_enum('EnumType', [
                 ('ENUM_START', 0),
                 ('ENUM_MIDDLE', 1),
                 ('ENUM_END', 3)]),
             call.on_const_int('CONST_1', '1'),
             call.on_namespace_end('inner_namespace'),
-            call.on_const_int('CONST_2', '0x0A'),
+            call.on_const_int('CONST_2', '10'),
+            call.on_symbol(ANY, 'for_test_namespace::CharsType'),
             call.on_typedef('CharsType', 'char [7]'),
             call.on_namespace_begin('bar'),            
             call.on_namespace_end('bar'), 
             
+            call.on_symbol(ANY, 'for_test_namespace::S1'),
             call.on_pod_begin('struct', 'S1', False),
             call.on_field('a', 'int'),
             call.on_field('b', 'CharsType'),
             call.on_pod_end('S1'),
             
+            call.on_symbol(ANY, 'for_test_namespace::S2'),
             call.on_pod_begin('struct', 'S2', True),
             call.on_field('a', 'int'),
             call.on_pod_end('S2'),
@@ -70,6 +86,7 @@ class Test(unittest.TestCase):
             call.on_function('use_s1', 'void', [('for_test_namespace::S1 &', 's1')]),
             call.on_function('use_s1_pointer', 'void', [('for_test_namespace::S1 *', 's1')]),
             
+            call.on_symbol(ANY, 'for_test_namespace::C2'),
             call.on_class_begin('class', 'C2', False),
             call.on_method('void_method', 'void', [], 'public', '', ANY),
             call.on_constructor('C2', [('int', 'a')]),
@@ -80,6 +97,7 @@ class Test(unittest.TestCase):
             call.on_field('a', 'int'),
             call.on_class_end('C2'),
             
+            call.on_symbol(ANY, 'for_test_namespace::C1'),
             call.on_class_begin('class', 'C1', False),
             call.on_constructor('C1', [('for_test_namespace::C2 *', 'c2')]),
             call.on_method('virtual_method', 'int', [], 'public', 'virtual', ANY),
@@ -100,6 +118,503 @@ class Test(unittest.TestCase):
         ])
 
         
+    def test_apply_cursor_filter(self):
+        mock = MagicMock()
+        apply([self.tu.cursor], mock, CursorFilter(['test_module/other.hpp']))
+
+        platform_macro = []
+        if sys.platform in ('linux2', 'linux'):
+            platform_macro = [
+                call.on_macro_value('unix', '1'),
+                call.on_macro_value('linux', '1'),
+            ]
+
+        self.assertListEqual(mock.mock_calls, [
+            call.on_file_begin(self.hpp_path),] +
+            platform_macro + [
+            call.on_file_end(),
+        ])
+
+    def test_apply_constant_expression(self):
+        directory = self.make_directory()
+        path = os.path.join(directory, 'constant.hpp')
+        with open(path, 'w') as f:
+            f.write('enum Color { RED = 1, GREEN = 2 };\n'
+                    '#define SHIFTED (1 << 4)\n'
+                    '#define COMBINED (SHIFTED | 0x3)\n'
+                    '#define MAX(a, b) ((a) > (b) ? (a) : (b))\n'
+                    '#define NOT_FIRST (!1 + 1)\n'
+                    '#define AND_FIRST (1 & 2 == 2)\n'
+                    '#define ALL_ONES (~0u)\n'
+                    '#define BIG_DIVIDED (0x7FFFFFFFFFFFFFFF / 3)\n'
+                    '#define TRUNCATED (-7 / 2 + -7 % 2)\n'
+                    '#define CAST ((int)1)\n'
+                    '#define TOO_LONG (' + ' + '.join(['1'] * 40) + ')\n'
+                    'const int MASK = SHIFTED - 1;\n')
+        mock = MagicMock()
+        apply([parse_cpp_file(path).cursor], mock, CursorFilter([path]))
+        self.assertIn(call.on_macro_value('SHIFTED', '16'), mock.mock_calls)
+        self.assertIn(call.on_macro_value('COMBINED', '19'), mock.mock_calls)
+        self.assertIn(call.on_macro_value('MAX', None), mock.mock_calls)
+        # C precedence and types, not python ones
+        self.assertIn(call.on_macro_value('NOT_FIRST', '1'), mock.mock_calls)
+        self.assertIn(call.on_macro_value('AND_FIRST', '1'), mock.mock_calls)
+        self.assertIn(call.on_macro_value('ALL_ONES', '4294967295'), mock.mock_calls)
+        self.assertIn(call.on_macro_value('BIG_DIVIDED', '3074457345618258602'), mock.mock_calls)
+        self.assertIn(call.on_macro_value('TRUNCATED', '-4'), mock.mock_calls)
+        # unsupported expression falls back to the first literal
+        self.assertIn(call.on_macro_value('CAST', '1'), mock.mock_calls)
+        # more tokens than scanned is not evaluated partly
+        self.assertIn(call.on_macro_value('TOO_LONG', None), mock.mock_calls)
+        self.assertIn(call.on_const_int('MASK', '15'), mock.mock_calls)
+
+    def test_token_data(self):
+        cursor = self.tu.cursor
+        tokens = list(cursor.get_tokens())
+        kinds, spellings, extents = cursor.get_token_data()
+        self.assertEqual(len(kinds), len(tokens))
+        self.assertListEqual(spellings, [t.spelling for t in tokens])
+        self.assertListEqual([k.name for k in kinds], [t.kind.name for t in tokens])
+        self.assertListEqual([(e.start.offset, e.end.offset) for e in extents],
+                             [(t.extent.start.offset, t.extent.end.offset) for t in tokens])
+
+        kinds, spellings, extents = cursor.get_token_data(3)
+        self.assertListEqual(spellings, [t.spelling for t in tokens[:3]])
+        self.assertEqual(len(kinds), 3)
+        self.assertEqual(len(extents), 3)
+
+    def test_apply_macro_filter(self):
+        def macros(cursor_filter):
+            mock = MagicMock()
+            apply([self.tu.cursor], mock, cursor_filter)
+            return [c for c in mock.mock_calls if c[0] == 'on_macro_value']
+
+        self.assertListEqual(macros(CursorFilter(macros='main')), [call.on_macro_value('DEFINE_1', "'1'")])
+        self.assertListEqual(macros(CursorFilter(macros='all', macro_regex='DEF')), [call.on_macro_value('DEFINE_1', "'1'")])
+        self.assertListEqual(macros(CursorFilter(macros='off')), [])
+        self.assertRaises(ValueError, CursorFilter, macros='some')
+
+        tu = parse_cpp_file(self.hpp_path, macros=False)
+        self.assertFalse(any(c.kind == cindex.CursorKind.MACRO_DEFINITION for c in tu.cursor.get_children()))
+
+    def test_apply_entity_filter(self):
+        mock = MagicMock()
+        apply([self.tu.cursor], mock, CursorFilter(
+            [self.hpp_path], macros='off', namespaces=['for_test_namespace::inner_namespace']))
+        self.assertListEqual(mock.mock_calls, [
+            call.on_file_begin(self.hpp_path),
+            call.on_namespace_begin('for_test_namespace'),
+            call.on_namespace_begin('inner_namespace'),
+            call.on_symbol(ANY, 'for_test_namespace::inner_namespace::IntType'),
+            call.on_typedef('IntType', 'int'),
+            call.on_symbol('c:@N@for_test_namespace@N@inner_namespace@E@EnumType',
+                           'for_test_namespace::inner_namespace::EnumType'),
+            call.on_enum('EnumType', [
+                ('ENUM_START', 0),
+                ('ENUM_MIDDLE', 1),
+                ('ENUM_END', 3)]),
+            call.on_const_int('CONST_1', '1'),
+            call.on_namespace_end('inner_namespace'),
+            call.on_namespace_end('for_test_namespace'),
+            call.on_file_end(),
+        ])
+
+        mock = MagicMock()
+        apply([self.tu.cursor], mock, CursorFilter(
+            [self.hpp_path], include=['for_test_namespace::C[0-9]'], exclude=['.*::C2', '.*::on_struct.*']))
+        self.assertListEqual([c[0] for c in mock.mock_calls if c[0].endswith('_begin')],
+                             ['on_file_begin', 'on_namespace_begin', 'on_namespace_begin',
+                              'on_namespace_begin', 'on_class_begin'])
+        self.assertListEqual([c[1][0] for c in mock.mock_calls if c[0] == 'on_method'],
+                             ['virtual_method', 'virtual_method_call_other'])
+        # the whole name must match, for_test_namespace::CONST_2 is not included
+        self.assertListEqual([c[1][0] for c in mock.mock_calls if c[0] == 'on_const_int'], [])
+
+        mock = MagicMock()
+        apply([self.tu.cursor], mock, CursorFilter([self.hpp_path], include=['for_test_namespace::C']))
+        self.assertFalse([c for c in mock.mock_calls if c[0] in ('on_class_begin', 'on_const_int')])
+
+    def test_profiler(self):
+        try:
+            import tracemalloc
+            tracing = tracemalloc.is_tracing()
+        except ImportError:
+            tracing = None
+        profiler = Profiler()
+        set_profiler(profiler)
+        try:
+            group = VisitorGroup([EventRecorder()], profiler)
+            apply([self.tu.cursor], group)
+        finally:
+            set_profiler(None)
+
+        self.assertListEqual(profiler.phases, ['visitor EventRecorder', 'apply'])
+        self.assertEqual(profiler.results['apply']['count'], 1)
+        self.assertGreater(profiler.results['visitor EventRecorder']['count'], 1)
+        if tracing is not None:
+            for name in profiler.phases:
+                self.assertIsNotNone(profiler.results[name]['peak'], name)
+            # tracing started by the profiler is stopped with it
+            self.assertEqual(profiler.started_tracing, False)
+            self.assertEqual(tracing, tracemalloc.is_tracing())
+
+    def test_parse_events_max_memory(self):
+        with self.assertRaises(MemoryLimitError) as context:
+            parse_events(self.hpp_path, session=Session(max_memory=1))
+        self.assertEqual(context.exception.header, self.hpp_path)
+        self.assertTrue(parse_events(self.hpp_path, session=Session(max_memory=1 << 40)))
+
+    def test_parse_events_unsaved_file(self):
+        session = Session()
+        with open(self.hpp_path, 'rb') as f:
+            session.add_unsaved_file('test_module/in_memory.hpp', f.read())
+        session.add_unsaved_file('test_module/umbrella.hpp', u'#include "in_memory.hpp"\n#define UMBRELLA 1\n')
+        self.assertFalse(os.path.exists('test_module/in_memory.hpp'))
+
+        # USR of typedef has the name of its file
+        events = [i for i in parse_events('test_module/in_memory.hpp', session=session) if i[0] != 'on_symbol']
+        self.assertEqual(events[1:], [i for i in parse_events(self.hpp_path) if i[0] != 'on_symbol'][1:])
+
+        events = parse_events('test_module/umbrella.hpp', session=session, cursor_filter=CursorFilter(macros='main'))
+        self.assertIn(('on_macro_value', ('UMBRELLA', '1')), events)
+
+    def test_generate(self):
+        directory = self.make_directory()
+        module_directory = os.path.join(directory, 'module')
+        outputs = generate([self.hpp_path], 'foo', module_directory)
+        self.assertFalse(os.path.exists(module_directory))
+        self.assertEqual(sorted(outputs), sorted(os.path.join(module_directory, i) for i in [
+            'foo.pxi', 'foo.pyx', 'foo_cppython.cpp', 'foo_cppython.hpp',
+            'foo_cppython.pxd', 'for_test.pxd', 'setup.py']))
+        self.assertTrue(all(isinstance(i, bytes) for i in outputs.values()))
+        self.assertIn(b'cdef cppclass C1:', outputs[os.path.join(module_directory, 'for_test.pxd')])
+        self.assertIn(b'"foo"', outputs[os.path.join(module_directory, 'setup.py')])
+
+    def test_generate_included_header(self):
+        path = os.path.join(os.path.abspath('test_module'), 'includer.hpp')
+        session = Session()
+        session.add_unsaved_file(path, '#include "for_test.hpp"\n'
+                                 'namespace includer { int use_c1(for_test_namespace::C1* c1); }\n')
+        headers = [self.hpp_path, path]
+        directory = 'module'
+        # like the command line, both target headers are allowed
+        outputs = generate(headers, 'foo', directory, session=session, cursor_filter=CursorFilter(headers, 'main'))
+
+        # entities of for_test.hpp are only wrapped once although includer.hpp includes it
+        includer = outputs[os.path.join(directory, 'includer.pxd')]
+        self.assertIn(b'use_c1', includer)
+        self.assertNotIn(b'for_test_namespace"', includer)
+        self.assertEqual(outputs[os.path.join(directory, 'foo.pyx')].count(b'cdef class S1:'), 1)
+        self.assertEqual(outputs[os.path.join(directory, 'foo_cppython.pxd')].count(b'cppclass C1_proxy('), 1)
+
+    def test_generate_modules(self):
+        directory = self.make_directory()
+        manifest = os.path.join(directory, 'modules.json')
+        with open(manifest, 'w') as f:
+            f.write('[{{"module": "foo/foo", "header": "{0}"}},'
+                    ' {{"module": "bar/bar", "header": ["{0}"], "macros": "off"}}]'.format(
+                        os.path.abspath(self.hpp_path)))
+        defaults = argparse.Namespace(
+            module=None, header=None, source=[], include=[], library=[], library_dir=[],
+            compile_flag=[], link_flag=[], object=[], allow=[], macros='main', macro_regex=None,
+            only_namespace=[], include_entity=[], exclude_entity=[], umbrella=False)
+        modules = [get_generate_arguments(i) for i in load_manifest(manifest, defaults)]
+        self.assertEqual([(i['directory'], i['module']) for i in modules],
+                         [(os.path.join(directory, 'foo'), 'foo'), (os.path.join(directory, 'bar'), 'bar')])
+
+        results = list(generate_modules(modules, jobs=1))
+        self.assertEqual([i[0] for i in results],
+                         [os.path.join(directory, 'foo', 'foo'), os.path.join(directory, 'bar', 'bar')])
+        self.assertIn(b'DEFINE_1', results[0][1][os.path.join(directory, 'foo', 'foo.pyx')])
+        self.assertNotIn(b'DEFINE_1', results[1][1][os.path.join(directory, 'bar', 'bar.pyx')])
+
+        for wrong in ('{"module": "foo/foo", "headers": ["foo.hpp"]}',
+                      '{"module": "foo/foo", "header": {"foo.hpp": 1}}',
+                      '{"module": ["foo/foo"], "header": ["foo.hpp"]}',
+                      '{"module": "foo/foo", "header": ["foo.hpp"], "umbrella": "yes"}',
+                      '{"module": "foo/foo", "header": ["foo.hpp"], "macro_regex": 1}',
+                      # options of the whole run are not ignored silently
+                      '{"module": "foo/foo", "header": ["foo.hpp"], "pch": true}',
+                      '{"module": "foo/foo", "header": ["foo.hpp"], "max_memory": "lots"}'):
+            with open(manifest, 'w') as f:
+                f.write('[' + wrong + ']')
+            self.assertRaises(ValueError, load_manifest, manifest, defaults)
+
+    def test_server(self):
+        directory = self.make_directory()
+        server = Server(ResidentSession(max_units=1))
+        request = {'version': cppython.__version__, 'cwd': os.getcwd(),
+                   'argv': ['-t', self.hpp_path, '-m', os.path.join(directory, 'foo')]}
+        response = server.handle(request)
+        self.assertIn(os.path.join(directory, 'for_test.pxd'), response['outputs'])
+        self.assertEqual([i[0] for i in response['modules']], [os.path.join(directory, 'foo')])
+        self.assertEqual(len(server.session.units), 1)
+        tu = list(server.session.units.values())[0][0]
+
+        # translation unit is kept and reused while header does not change
+        self.assertEqual(server.handle(request)['outputs'].keys(), response['outputs'].keys())
+        self.assertIs(list(server.session.units.values())[0][0], tu)
+
+        self.assertIn('error', server.handle(dict(request, argv=['-t', 'missing.hpp', '-m', 'foo'])))
+        self.assertIn('error', server.handle(dict(request, version='0')))
+        self.assertTrue(server.running)
+
+        output = BytesIO()
+        server.serve_stream(BytesIO(b'{"ping": true}\n\n{"stop": true}\n{"ping": true}\n'), output)
+        self.assertEqual([json.loads(u(i)) for i in output.getvalue().splitlines()],
+                         [{'version': cppython.__version__}, {'version': cppython.__version__, 'stopped': True}])
+        self.assertFalse(server.running)
+        server.session.clear()
+        self.assertEqual(len(server.session.units), 0)
+        self.assertTrue(ResidentSession(stubs=True).stubs)
+
+        # a generator which does not answer is given up
+        import socket
+        path = os.path.join(directory, 'busy.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            listener.listen(1)
+            self.assertIsNone(request_server(path, {'ping': True}, 0.1))
+        finally:
+            listener.close()
+
+        # file which is not a socket is left alone
+        path = os.path.join(directory, 'server.sock')
+        with open(path, 'w') as f:
+            f.write('not a socket')
+        self.assertRaises(RuntimeError, server.serve_socket, path)
+        self.assertTrue(os.path.isfile(path))
+        os.remove(path)
+
+        # silent client is dropped, so the next one is answered
+        import threading
+        self.addCleanup(setattr, cppython, 'IDLE_TIMEOUT', cppython.IDLE_TIMEOUT)
+        cppython.IDLE_TIMEOUT = 0.2
+        server.running = True
+        thread = threading.Thread(target=server.serve_socket, args=(path,))
+        thread.start()
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            silent.connect(path)
+            self.assertEqual(request_server(path, {'ping': True}, 5), {'version': cppython.__version__})
+            self.assertTrue(request_server(path, {'stop': True}, 5)['stopped'])
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        finally:
+            silent.close()
+
+    def test_parse_events_stub_std(self):
+        directory = self.make_directory()
+        path = os.path.join(directory, 'std.hpp')
+        with open(path, 'w') as f:
+            f.write('#include <string>\n#include <vector>\n#include <map>\n'
+                    'struct Named { std::string name; int id; };\n'
+                    'struct Plain { int id; std::size_t size; };\n'
+                    'std::vector<int> ids(const std::map<std::string, int>& m, std::string* s);\n')
+        cursor_filter = CursorFilter([path], macros='off')
+        session = Session(stubs=True)
+        self.assertListEqual(parse_events(path, session=session, cursor_filter=cursor_filter), [
+            ('on_file_begin', (path,)),
+            ('on_symbol', ('c:@S@Named', 'Named')),
+            ('on_class_begin', ('struct', 'Named', False)),
+            ('on_field', ('name', 'std::string')),
+            ('on_field', ('id', 'int')),
+            ('on_class_end', ('Named',)),
+            ('on_symbol', ('c:@S@Plain', 'Plain')),
+            ('on_pod_begin', ('struct', 'Plain', False)),
+            ('on_field', ('id', 'int')),
+            ('on_field', ('size', 'std::size_t')),
+            ('on_pod_end', ('Plain',)),
+            ('on_function', ('ids', 'std::vector<int>', [
+                ('const std::map<std::string, int> &', 'm'), ('std::string *', 's')])),
+            ('on_file_end', ()),
+        ])
+        self.assertEqual(session.stub_failures, set())
+
+        # bitset is not stubbed, parsed with the real headers instead
+        with open(path, 'a') as f:
+            f.write('#include <bitset>\n')
+        parse_events(path, session=session, cursor_filter=cursor_filter)
+        self.assertEqual(session.stub_failures, set([path]))
+
+        # other errors are not the stubs' fault, no parse again
+        other = os.path.join(directory, 'other.hpp')
+        with open(other, 'w') as f:
+            f.write('#include <vector>\n#include "missing_project.hpp"\nstd::vector<int> ids();\n')
+        parse_events(other, session=session, cursor_filter=CursorFilter([other], macros='off'))
+        self.assertEqual(session.stub_failures, set([path]))
+
+    def test_symbol_index(self):
+        directory = self.make_directory()
+        symbols = SymbolIndex(os.path.join(directory, 'symbols.sqlite'))
+        foo_directory, bar_directory = os.path.join(directory, 'foo'), os.path.join(directory, 'bar')
+        nested = os.path.join(os.path.abspath('test_module'), 'nested.hpp')
+        session = Session()
+        session.add_unsaved_file(nested, 'namespace outer_namespace {\n'
+                                 'struct Outer { struct Inner { int b; }; int a; };\n'
+                                 '}\n')
+        generate([self.hpp_path, nested], 'foo', foo_directory, session=session, symbols=symbols)
+
+        usrs = {}
+        for cursor in self.tu.cursor.walk_preorder():
+            if cursor.location.file and cursor.location.file.name.endswith(b'for_test.hpp'):
+                usrs[(u(cursor.spelling), cursor.kind)] = u(cursor.get_usr())
+        for name, kind, cursor_kind in [
+                ('for_test_namespace::S1', 'pod', cindex.CursorKind.STRUCT_DECL),
+                ('for_test_namespace::S2', 'pod', cindex.CursorKind.STRUCT_DECL),
+                ('for_test_namespace::S2', 'typedef', cindex.CursorKind.TYPEDEF_DECL),
+                ('for_test_namespace::C1', 'class', cindex.CursorKind.CLASS_DECL),
+                ('for_test_namespace::inner_namespace::EnumType', 'enum', cindex.CursorKind.ENUM_DECL),
+                ('for_test_namespace::inner_namespace::IntType', 'typedef', cindex.CursorKind.TYPEDEF_DECL)]:
+            symbol = symbols.lookup(name, (kind,))
+            self.assertEqual(symbol[0], usrs[(name.split('::')[-1], cursor_kind)])
+            self.assertEqual(symbol[4:7], ('foo', os.path.abspath(foo_directory), 'for_test'))
+        # nested class is qualified by its class, and referred through it in pxd
+        symbol = symbols.lookup('outer_namespace::Outer::Inner', ('pod',))
+        self.assertEqual(symbol[0], 'c:@N@outer_namespace@S@Outer@S@Inner')
+        self.assertEqual(symbol[3], 'Outer.Inner')
+
+        # module of another directory cimports from there
+        path = os.path.join(os.path.abspath('test_module'), 'user.hpp')
+        session.add_unsaved_file(path, '#include "for_test.hpp"\n#include "nested.hpp"\n'
+                                 'int use_c1(for_test_namespace::C1* c1, const for_test_namespace::S1& s1);\n'
+                                 'void use_inner(outer_namespace::Outer::Inner* inner);\n'
+                                 'class User {\npublic:\n    User(const for_test_namespace::S1& s1);\n'
+                                 '    int use(for_test_namespace::C1* c1);\n    int size();\n};\n')
+        outputs = generate([path], 'bar', bar_directory, session=session, symbols=symbols)
+        pxd = outputs[os.path.join(bar_directory, 'user.pxd')]
+        self.assertIn(b'cimport for_test\n', pxd)
+        self.assertIn(b'cimport nested\n', pxd)
+        self.assertIn(b'cdef int use_c1(for_test.C1 * c1, for_test.S1 s1)', pxd)
+        self.assertIn(b'cdef void use_inner(nested.Outer.Inner * inner)', pxd)
+        # their cdef classes could not be cimported by the pyx
+        pyx = outputs[os.path.join(bar_directory, 'bar.pyx')]
+        self.assertIn(b'# use_c1 is not wrapped, it uses for_test.C1, for_test.S1 wrapped by another module\n', pyx)
+        self.assertIn(b"raise TypeError('User takes for_test.S1 wrapped by another module')", pyx)
+        self.assertIn(b'# use is not wrapped, it uses for_test.C1 wrapped by another module\n', pyx)
+        self.assertIn(b'def size(self, ):', pyx)
+        self.assertNotIn(b'def use(', pyx)
+        self.assertNotIn(b'use_c1(', pyx.replace(b'# use_c1 is', b''))
+        setup = outputs[os.path.join(bar_directory, 'setup.py')]
+        self.assertIn(u('include_dirs = {}').format([os.path.abspath(foo_directory)]).encode('utf-8'), setup)
+        self.assertIn(u('include_path={}').format([os.path.abspath(foo_directory)]).encode('utf-8'), setup)
+        self.assertIsNone(symbols.lookup('for_test_namespace::C1', ('pod',)))
+        symbols.close()
+
+    def test_parse_umbrella(self):
+        path = os.path.join(os.path.abspath('test_module'), 'second.hpp')
+        session = Session()
+        session.add_unsaved_file(path, '#include "for_test.hpp"\n'
+                                 'namespace second_namespace {\n'
+                                 'typedef struct { int x; } Point;\n'
+                                 'for_test_namespace::S1 make_s1(int a);\n'
+                                 '}\n')
+        headers = [self.hpp_path, path]
+        events = parse_umbrella(headers, session=session, cursor_filter=CursorFilter(headers, 'main'))
+
+        # entities of for_test.hpp are only routed to it, not to second.hpp including it
+        self.assertEqual(events[0], parse_events(self.hpp_path, session=session,
+                                                 cursor_filter=CursorFilter([self.hpp_path], 'main')))
+        self.assertEqual(events[1], parse_events(path, session=session, cursor_filter=CursorFilter([path], 'main')))
+        self.assertEqual(events[1][0], ('on_file_begin', (path,)))
+        self.assertIn(('on_function', ('make_s1', 'for_test_namespace::S1', [('int', 'a')])), events[1])
+        # the umbrella header is not left in the session
+        self.assertEqual(list(session.unsaved_files), [path])
+
+    def test_visitor_group(self):
+        events = record_events(self.tu)
+        recorders = [EventRecorder(), EventRecorder()]
+        replay(events, VisitorGroup(recorders))
+        self.assertEqual(recorders[0].events, events)
+        self.assertEqual(recorders[1].events, events)
+
+        visitors = [v('foo', 'test_module', outputs={}) for v in VISITORS]
+        group = VisitorGroup(visitors)
+        # handlers are resolved once, BaseVisitor no-ops are skipped
+        self.assertIs(group.on_class_declaration, group.on_class_declaration)
+        self.assertIs(group.on_pod_declaration, noop_dispatcher)
+        # PxdVisitor does nothing on module end
+        self.assertEqual(VisitorGroup(visitors[:2]).on_module_end, visitors[1].on_module_end)
+
+    def get_tree_rows(self, cursor_filter):
+        '''Return [kind, end] of the cursors build_ast_table() keeps, found by listing children'''
+        enter = get_walk_filter(cursor_filter)
+        rows = []
+
+        def visit(cursor, walk_into):
+            row = len(rows)
+            rows.append([cursor.kind.value, row + 1])
+            if walk_into:
+                for child in cursor.get_children():
+                    child_walk_into = enter(child, cursor)
+                    if child_walk_into is not None:
+                        visit(child, child_walk_into)
+                rows[row][1] = len(rows)
+        visit(self.tu.cursor, True)
+        return rows
+
+    def test_walk(self):
+        cursor_filter = CursorFilter([self.hpp_path])
+        table = build_ast_table([self.tu.cursor], cursor_filter)
+        self.assertEqual(table.kind[0], cindex.CursorKind.TRANSLATION_UNIT.value)
+        self.assertEqual(table.end[0], len(table))
+        self.assertListEqual([list(i) for i in zip(table.kind, table.end)], self.get_tree_rows(cursor_filter))
+        # cursors of other files are skipped
+        self.assertLessEqual(set(table.string(i) for i in table.file), set([None, self.hpp_path]))
+
+    def test_visit_subtree_error(self):
+        visited = []
+
+        def enter(child, parent):
+            visited.append(child)
+            if len(visited) == 3:
+                raise KeyError('third')
+            return True
+
+        # not swallowed by the ctypes callback
+        self.assertRaises(KeyError, self.tu.cursor.visit_subtree, enter, lambda cursor: None)
+        self.assertEqual(len(visited), 3)
+        # nor is the one of building a row
+        evaluator = MagicMock()
+        evaluator.evaluate.side_effect = KeyError('evaluate')
+        self.assertRaises(KeyError, build_ast_table, [self.tu.cursor], CursorFilter([self.hpp_path]), evaluator)
+
+    def test_ast_table(self):
+        table = build_ast_table([self.tu.cursor])
+        self.assertEqual(pickle.loads(pickle.dumps(table, pickle.HIGHEST_PROTOCOL)), table)
+        # rows are appended while walking, in preorder
+        self.assertListEqual([list(i) for i in zip(table.kind, table.end)], self.get_tree_rows(CursorFilter()))
+
+        methods = []
+        visitor = MagicMock()
+        visitor.on_method.side_effect = lambda *l: methods.append(l[-1])
+        del self.tu
+        table.apply(visitor)
+
+        row = methods[0]
+        self.assertEqual(row.kind, cindex.CursorKind.CXX_METHOD)
+        self.assertEqual(row.spelling, 'void_method')
+        self.assertEqual(row.access, 'public')
+        self.assertEqual(row.arguments, [])
+        self.assertEqual(row.location[0], self.hpp_path)
+        self.assertEqual(table.row(table.parent[row.index]).spelling, 'C2')
+
+        # built-in macros have no file, they are routed by None
+        table = build_ast_table([parse_cpp_file(self.hpp_path).cursor], CursorFilter(macros='all'))
+        files = set()
+        table.apply(MagicMock(), lambda name: files.add(name))
+        self.assertEqual(files, set([None, self.hpp_path]))
+
+    def test_lazy_binding(self):
+        lib = cindex.conf.lib
+        self.assertIsInstance(lib, cindex.LazyLibrary)
+        self.assertNotIn('clang_isPreprocessing', lib.__dict__)
+        self.assertListEqual(lib.clang_isPreprocessing.argtypes, [cindex.CursorKind])
+        self.assertIn('clang_isPreprocessing', lib.__dict__)
+
     def test_apply_visitor(self):
         directory = 'test_module'
         module = 'foo'
@@ -110,6 +625,65 @@ class Test(unittest.TestCase):
             module, directory, 
             sources=['test_module/for_test.cpp'], compile_flag=['-Wno-unused-function'])
 
+    def test_parse_events_cache(self):
+        directory = self.make_directory()
+        cache = HeaderCache(directory)
+        events = parse_events(self.hpp_path, cache)
+        with mock.patch('cppython.parse_cpp_file') as parse:
+            self.assertListEqual(parse_events(self.hpp_path, cache), events)
+            self.assertFalse(parse.called)
+
+    def test_parse_events_pch(self):
+        directory = self.make_directory()
+        included = os.path.join(directory, 'included.hpp')
+        header = os.path.join(directory, 'header.hpp')
+        with open(included, 'w') as f:
+            f.write('#ifndef INCLUDED_HPP\n#define INCLUDED_HPP\nstruct Included { int a; };\n#endif\n')
+        with open(header, 'w') as f:
+            f.write('#include "included.hpp"\nstruct Main { Included i; };\nint use(Included* p);\n')
+        cursor_filter = CursorFilter([header, included])
+        session = Session(pch_directory=os.path.join(directory, 'pch'))
+        events = parse_events(header, session=session, cursor_filter=cursor_filter)
+        self.assertIn(('on_field', ('a', 'int')), events)
+        self.assertListEqual(events, parse_events(header, session=Session(), cursor_filter=cursor_filter))
+
+        # pch is rebuilt once a file it includes changes
+        pch = session.get_pch(header)
+        with open(pch, 'rb') as f:
+            content = f.read()
+        with open(included, 'w') as f:
+            f.write('#ifndef INCLUDED_HPP\n#define INCLUDED_HPP\nstruct Included { int a; int b; };\n#endif\n')
+        self.assertEqual(session.get_pch(header), pch)
+        with open(pch, 'rb') as f:
+            self.assertNotEqual(f.read(), content)
+        events = parse_events(header, session=session, cursor_filter=cursor_filter)
+        self.assertIn(('on_field', ('b', 'int')), events)
+        self.assertListEqual(events, parse_events(header, session=Session(), cursor_filter=cursor_filter))
+
+    def test_parse_headers_parallel(self):
+        headers = [self.hpp_path, self.hpp_path]
+        self.assertListEqual(parse_headers(headers, jobs=2), parse_headers(headers, jobs=1))
+
+    def test_session_index(self):
+        session = Session()
+        tu = session.parse(self.hpp_path)
+        self.assertIs(session.parse(self.hpp_path).index, tu.index)
+
+    def test_watcher(self):
+        directory = self.make_directory()
+        header = os.path.join(directory, 'watched.hpp')
+        shutil.copy(self.hpp_path, header)
+        watcher = Watcher([header], 'foo', directory, Session())
+        self.assertTrue(watcher.session.preamble)
+        self.assertEqual(len(watcher.generate()), 6)
+        self.assertListEqual(watcher.poll(), [])
+
+        with open(header, 'a') as f:
+            f.write('int added_function(int a);\n')
+        os.utime(header, (0, 0))
+        self.assertListEqual(watcher.poll(), [
+            os.path.join(directory, i) for i in ('foo.pyx', 'watched.pxd')])
+
         
 if __name__ == '__main__':
     unittest.main()